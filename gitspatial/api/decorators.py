@@ -1,5 +1,8 @@
+import itertools
 from functools import wraps
 
+from django.views.decorators.http import condition
+
 
 def jsonp(f):
     @wraps(f)
@@ -7,11 +10,36 @@ def jsonp(f):
         resp = f(request, *args, **kwargs)
         #if resp.status_code != 200:
         #    return resp
+        if resp.status_code == 304 or not resp['Content-Type'].startswith('application/json'):
+            # Nothing to wrap, the client already has it or it isn't JSON
+            return resp
         if 'callback' in request.GET:
             callback = request.GET['callback']
             resp['Content-Type'] = 'text/javascript'
-            resp.content = "%s(%s)" % (callback, resp.content)
+            if resp.streaming:
+                resp.streaming_content = itertools.chain([callback + '('], resp.streaming_content, [')'])
+            else:
+                resp.content = "%s(%s)" % (callback, resp.content)
             return resp
         else:
             return resp
     return jsonp_wrapper
+
+
+def condition_on_get(etag_func=None, last_modified_func=None):
+    """
+    Like django.views.decorators.http.condition, but only for GETs
+
+    Conditional headers on other methods are about changing the resource, which a
+    query POST doesn't do, so they're ignored rather than answered with a 304 or 412.
+    """
+    def decorator(f):
+        conditional = condition(etag_func=etag_func, last_modified_func=last_modified_func)(f)
+
+        @wraps(f)
+        def condition_on_get_wrapper(request, *args, **kwargs):
+            if request.method == 'GET':
+                return conditional(request, *args, **kwargs)
+            return f(request, *args, **kwargs)
+        return condition_on_get_wrapper
+    return decorator
@@ -1,2 +1,14 @@
 class InvalidSpatialParameterException(Exception):
     "An invalid spatial parameter was passed"
+
+
+class InvalidCursorException(Exception):
+    "An invalid pagination cursor was passed"
+
+
+class InvalidFormatException(Exception):
+    "An unknown output format was asked for"
+
+
+class InvalidPropertyFilterException(Exception):
+    "An invalid property filter was passed"
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+
+logger = logging.getLogger(__name__)
+
+# Hit and miss counters live in their own cache so culling responses can't reset them
+_counter_timeout = 60 * 60 * 24 * 365
+
+
+def get_api_cache():
+    return get_cache('api')
+
+
+def get_api_stats_cache():
+    return get_cache('api_stats')
+
+
+def query_cache_key(feature_set, params, *extra):
+    """
+    A cache key for a feature set query, params being a QueryDict of the query arguments
+
+    The feature set's generation is part of the key, so finishing a sync invalidates
+    every cached response for it. The JSONP callback is left out since it's applied
+    to the response after the fact. Anything else the response depends on, like the
+    hash of a posted geometry, goes in extra.
+    """
+    return 'feature_set_query:' + _query_hash(feature_set, params, exclude=('callback',), extra=extra)
+
+
+def query_etag(feature_set, params, *extra):
+    """
+    A strong ETag for a feature set query, changing whenever a sync finishes or the query arguments change
+
+    Anything else the response depends on, like a negotiated format or the hash of a
+    posted geometry, goes in extra.
+    """
+    return _query_hash(feature_set, params, extra=extra)
+
+
+def _query_hash(feature_set, params, exclude=(), extra=()):
+    normalized = sorted((key, sorted(values)) for key, values in params.lists() if key not in exclude)
+    raw = json.dumps([feature_set.id, feature_set.generation, normalized] + list(extra))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def get_cached_query(key):
+    content = get_api_cache().get(key)
+    _count('hits' if content is not None else 'misses')
+    return content
+
+
+def set_cached_query(key, content):
+    """
+    Cache a response body unless it's over API_CACHE_MAX_ENTRY_SIZE bytes
+
+    With the cache backend's MAX_ENTRIES this puts a ceiling on the cache's size.
+    """
+    if len(content) > settings.API_CACHE_MAX_ENTRY_SIZE:
+        logger.debug('[api]: Not caching {0} byte response'.format(len(content)))
+        return
+    get_api_cache().set(key, content)
+
+
+def cache_stats():
+    """
+    A dict of hits and misses for the query response cache
+    """
+    counters = get_api_stats_cache().get_many(['feature_set_query:hits', 'feature_set_query:misses'])
+    return {
+        'hits': counters.get('feature_set_query:hits', 0),
+        'misses': counters.get('feature_set_query:misses', 0),
+    }
+
+
+def _count(counter):
+    cache = get_api_stats_cache()
+    key = 'feature_set_query:{0}'.format(counter)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, _counter_timeout)
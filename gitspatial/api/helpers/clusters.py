@@ -0,0 +1,74 @@
+import json
+
+from django.conf import settings
+from django.db import connection
+
+from ..exceptions import InvalidSpatialParameterException
+
+
+default_grid_cell = 0.1
+default_geohash_cell = 5
+
+# Query parameters shaping feature geometries or responses that clusters have no use for
+unsupported_params = ('stream', 'simplify', 'zoom', 'precision')
+
+# Expressions for the columns identifying the cell a centroid is in
+_cells = {
+    'grid': ('floor(ST_X(centroid) / %s)', 'floor(ST_Y(centroid) / %s)'),
+    'geohash': ('ST_GeoHash(centroid, %s)',),
+}
+
+
+def cluster_args(method, cell=None):
+    """
+    A (method, cell) tuple for grid clusters with cell size in degrees or geohash clusters with cell characters
+    """
+    if method == 'grid':
+        try:
+            cell = float(cell) if cell is not None else default_grid_cell
+        except ValueError:
+            raise InvalidSpatialParameterException('The cell parameter must be parseable as a float')
+        if cell <= 0:
+            raise InvalidSpatialParameterException('The cell parameter must be greater than 0')
+    elif method == 'geohash':
+        try:
+            cell = int(cell) if cell is not None else default_geohash_cell
+        except ValueError:
+            raise InvalidSpatialParameterException('The cell parameter must be an integer')
+        if not 1 <= cell <= 12:
+            raise InvalidSpatialParameterException('The cell parameter must be between 1 and 12')
+    else:
+        raise InvalidSpatialParameterException('The cluster parameter must be grid or geohash')
+    return (method, cell)
+
+
+def clusters(features, method, cell):
+    """
+    GeoJSON Point features summarizing a queryset of features in cells, and the number of features
+
+    Each is at the centroid of its cell's features and has their count. Grid cells have
+    their bbox and geohash cells their geohash. The API_CLUSTER_MAX_CELLS most populated
+    cells are returned, the number of features counts those in every cell.
+    """
+    sql, params = features.values('geom').query.sql_with_params()
+    cell_columns = _cells[method]
+    # Cell columns come after the count, centroid and total
+    group_by = ', '.join(str(i + 4) for i in range(len(cell_columns)))
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT count(*), ST_AsGeoJSON(ST_Centroid(ST_Collect(centroid))), sum(count(*)) OVER (), {0} '
+        'FROM (SELECT ST_Centroid(features.geom) AS centroid FROM ({1}) AS features) AS centroids '
+        'GROUP BY {2} ORDER BY count(*) DESC LIMIT %s'.format(', '.join(cell_columns), sql, group_by),
+        (cell,) * len(cell_columns) + tuple(params) + (settings.API_CLUSTER_MAX_CELLS,))
+    cluster_features = []
+    total_count = 0
+    for row in cursor.fetchall():
+        # The window sum is over every cell, before the LIMIT
+        count, geometry, total_count = row[0], row[1], int(row[2])
+        if method == 'grid':
+            x, y = row[3:]
+            properties = {'count': count, 'bbox': [x * cell, y * cell, (x + 1) * cell, (y + 1) * cell]}
+        else:
+            properties = {'count': count, 'geohash': row[3]}
+        cluster_features.append({'type': 'Feature', 'properties': properties, 'geometry': json.loads(geometry)})
+    return cluster_features, total_count
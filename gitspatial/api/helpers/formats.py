@@ -0,0 +1,53 @@
+from django.db import connection
+
+from ..exceptions import InvalidFormatException
+
+
+# Binary output formats and their media types, besides the default GeoJSON
+media_types = {
+    'flatgeobuf': 'application/flatgeobuf',
+    'geobuf': 'application/x-protobuf',
+}
+
+# PostGIS aggregates encoding rows with geom and attributes columns in each format
+_aggregates = {
+    'flatgeobuf': "ST_AsFlatGeobuf(features, false, 'geom')",
+    'geobuf': "ST_AsGeobuf(features, 'geom')",
+}
+
+
+def output_format(format_param=None, accept=''):
+    """
+    The output format asked for by a format parameter or else an Accept header
+
+    Returns "geojson" unless a binary format in media_types was asked for.
+    """
+    if format_param is not None:
+        if format_param != 'geojson' and format_param not in media_types:
+            raise InvalidFormatException('The format parameter must be one of geojson, flatgeobuf or geobuf')
+        return format_param
+
+    for media_range in accept.split(','):
+        media_type = media_range.split(';')[0].strip()
+        for name, format_media_type in media_types.items():
+            if media_type == format_media_type:
+                return name
+    return 'geojson'
+
+
+def encoded_features(features, page, output_format, order_fields=()):
+    """
+    A slice of a queryset of features encoded in a binary output format by PostGIS
+
+    Returns the encoding as bytes, the number of features in it and the largest id
+    among them, None if there are none. order_fields are extra select names the
+    queryset is ordered by, which are left out of the encoded features. Needs PostGIS
+    3.2 for FlatGeobuf.
+    """
+    sql, params = features.values('id', 'geom', 'properties', *order_fields)[page].query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT {0}, count(*), max(id) FROM (SELECT id, geom, properties::jsonb AS attributes FROM ({1}) AS ordered) AS features'.format(
+            _aggregates[output_format], sql), params)
+    content, count, last_id = cursor.fetchone()
+    return (str(content) if content is not None else '', count, last_id)
@@ -1,8 +1,19 @@
+import base64
+import binascii
+import json
+import math
+
+from django.contrib.gis.gdal.error import OGRException
+from django.contrib.gis.geos import GEOSGeometry
+from django.contrib.gis.geos.error import GEOSException
 from django.contrib.gis.geos.polygon import Polygon
 from django.contrib.gis.geos.point import Point
 from django.contrib.gis.measure import D
+from django.utils.datastructures import SortedDict
+
+from gitspatial.models import Feature
 
-from ..exceptions import InvalidSpatialParameterException
+from ..exceptions import InvalidCursorException, InvalidPropertyFilterException, InvalidSpatialParameterException
 
 
 def by_bbox(bbox_string):
@@ -31,6 +42,246 @@ def by_lat_lon_distance(lat, lon, distance):
 
     point = Point(x=lon, y=lat, srid=4326)
 
-    return {
+    distance_args = {
         'geom__distance_lte': (point, D(m=distance))
     }
+    # Spheroid distances are only worked out for features whose bounding box is close enough
+    bbox = distance_bbox(lat, lon, distance)
+    if bbox is not None:
+        distance_args['geom__bboverlaps'] = Polygon.from_bbox(bbox)
+    return distance_args
+
+
+def distance_bbox(lat, lon, distance):
+    """
+    A bbox holding everything within distance meters of a point, or None if it would cross a pole or the antimeridian
+
+    Degrees are converted to meters with their shortest length, plus a margin.
+    """
+    lat_distance = distance / 110574.0 * 1.01
+    ymin, ymax = lat - lat_distance, lat + lat_distance
+    if ymin <= -90 or ymax >= 90:
+        return None
+    lon_distance = distance / (111320.0 * math.cos(math.radians(max(abs(ymin), abs(ymax))))) * 1.01
+    xmin, xmax = lon - lon_distance, lon + lon_distance
+    if xmin < -180 or xmax > 180:
+        return None
+    return (xmin, ymin, xmax, ymax)
+
+
+# Spatial predicates a posted geometry can be queried with, features intersecting, within or containing it
+geometry_predicates = ('intersects', 'within', 'contains')
+
+
+def by_geometry(body):
+    """
+    Filter arguments for a JSON request body with a GeoJSON geometry and a predicate, intersects by default
+    """
+    try:
+        query = json.loads(body)
+    except ValueError:
+        raise InvalidSpatialParameterException('The request body must be JSON')
+
+    if not isinstance(query, dict) or 'geometry' not in query:
+        raise InvalidSpatialParameterException('The request body must have a geometry')
+
+    predicate = query.get('predicate', 'intersects')
+    if predicate not in geometry_predicates:
+        raise InvalidSpatialParameterException('The predicate must be one of intersects, within or contains')
+
+    try:
+        geometry = GEOSGeometry(json.dumps(query['geometry']))
+    except (ValueError, TypeError, GEOSException, OGRException):
+        raise InvalidSpatialParameterException('The geometry must be a valid GeoJSON geometry')
+    if geometry.srid is None:
+        geometry.srid = 4326
+
+    # The bounding box comparison can be answered from the spatial index alone
+    return {
+        'geom__bboverlaps': geometry,
+        'geom__' + predicate: geometry,
+    }
+
+
+def by_nearest(lat, lon, nearest):
+    try:
+        lat = float(lat)
+        lon = float(lon)
+    except (TypeError, ValueError):
+        raise InvalidSpatialParameterException('Parameters lat and lon must be parseable as floats when using nearest')
+
+    try:
+        nearest = int(nearest)
+    except ValueError:
+        raise InvalidSpatialParameterException('The nearest parameter must be an integer')
+    if nearest < 1:
+        raise InvalidSpatialParameterException('The nearest parameter must be greater than 0')
+
+    point = Point(x=lon, y=lat, srid=4326)
+
+    # Meters on the spheroid, only worked out for the features nearest_features leaves
+    return {
+        'select': {'distance_order': 'ST_Distance(gitspatial_feature.geom::geography, ST_GeomFromText(%s, 4326)::geography)'},
+        'select_params': (point.wkt,),
+        'order_by': ['distance_order'],
+    }
+
+
+def nearest_features(features, nearest_args, count):
+    """
+    A queryset of features narrowed down to those that can be among the count nearest to by_nearest's point
+
+    PostGIS finds the count nearest in degrees by walking the spatial index for <-> in
+    ORDER BY. Those aren't always the nearest in meters away from the equator, where a
+    degree of longitude is shorter than one of latitude, but the nearest in meters are
+    no farther than the farthest of them. So everything within that many meters is
+    left, for by_nearest to order.
+    """
+    wkt = nearest_args['select_params'][0]
+    distances = features.extra(
+        select=SortedDict([
+            ('planar_distance', 'gitspatial_feature.geom <-> ST_GeomFromText(%s, 4326)'),
+            ('distance', 'ST_Distance(gitspatial_feature.geom::geography, ST_GeomFromText(%s, 4326)::geography)'),
+        ]),
+        select_params=(wkt, wkt),
+        order_by=['planar_distance'],
+    ).values_list('planar_distance', 'distance')[:count]
+    distances = [distance for planar_distance, distance in distances]
+    if len(distances) < count:
+        # Every feature is one of the nearest
+        return features
+    # A hair more so rounding can't leave out a feature at exactly that distance
+    radius = max(distances) * (1 + 1e-9) + 0.001
+    point = GEOSGeometry(wkt, srid=4326)
+    features = features.extra(
+        where=['ST_DWithin(gitspatial_feature.geom::geography, ST_GeomFromText(%s, 4326)::geography, %s)'],
+        params=[wkt, radius],
+    )
+    bbox = distance_bbox(point.y, point.x, radius)
+    if bbox is not None:
+        features = features.filter(geom__bboverlaps=Polygon.from_bbox(bbox))
+    return features
+
+
+def by_cursor(cursor_string):
+    try:
+        feature_id = int(base64.urlsafe_b64decode(str(cursor_string)))
+    except (TypeError, ValueError, binascii.Error, UnicodeEncodeError):
+        raise InvalidCursorException('The cursor parameter must be a next value from a previous response')
+
+    return {
+        'id__gt': feature_id
+    }
+
+
+def encode_cursor(feature_id):
+    return base64.urlsafe_b64encode(str(feature_id))
+
+
+def simplified_geom(simplify=None, zoom=None):
+    """
+    The Feature field with geometries simplified for a tolerance in degrees or a web map zoom level
+
+    The coarsest stored simplification within the tolerance is used, or geom if none is.
+    A zoom level's tolerance is the width of a 256 pixel tile's pixel at the equator.
+    """
+    if simplify is not None:
+        try:
+            tolerance = float(simplify)
+        except ValueError:
+            raise InvalidSpatialParameterException('The simplify parameter must be parseable as a float')
+    elif zoom is not None:
+        try:
+            zoom = int(zoom)
+        except ValueError:
+            raise InvalidSpatialParameterException('The zoom parameter must be an integer')
+        tolerance = 360.0 / (256 * 2 ** max(zoom, 0))
+    else:
+        return 'geom'
+
+    for field_tolerance, field in Feature.simplified_geoms:
+        if field_tolerance <= tolerance:
+            return field
+    return 'geom'
+
+
+def geometry_precision(precision):
+    try:
+        precision = int(precision)
+    except ValueError:
+        raise InvalidSpatialParameterException('The precision parameter must be an integer')
+
+    if not 0 <= precision <= 15:
+        raise InvalidSpatialParameterException('The precision parameter must be between 0 and 15')
+
+    return precision
+
+
+# Query arguments starting with this filter on a property, prop.<key>, prop.<key>__gte and so on
+property_prefix = 'prop.'
+
+_range_operators = {'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+
+
+def by_properties(params):
+    """
+    extra() arguments for the property filters in a QueryDict of query arguments, or None if there aren't any
+
+    Equality and __in filters are jsonb containment (@>), which the GIN index on
+    properties answers. A value is matched both as a string and as the JSON number,
+    boolean or null it spells, so prop.zipcode=28202 matches "28202" and 28202.
+    Ranges compare numbers when given a number and strings otherwise.
+    """
+    where, where_params = [], []
+    for name, values in sorted(params.lists()):
+        if not name.startswith(property_prefix):
+            continue
+        key, operator = name[len(property_prefix):], 'exact'
+        if '__' in key and key.rsplit('__', 1)[1] in _range_operators.keys() + ['in']:
+            key, operator = key.rsplit('__', 1)
+        if not key:
+            raise InvalidPropertyFilterException('Property filters must name a property, like prop.name=value')
+        for value in values:
+            if operator in _range_operators:
+                clause, clause_params = _property_range(key, _range_operators[operator], value)
+            elif operator == 'in':
+                clause, clause_params = _property_containment(key, value.split(','))
+            else:
+                clause, clause_params = _property_containment(key, [value])
+            where.append(clause)
+            where_params.extend(clause_params)
+
+    if not where:
+        return None
+
+    return {
+        'where': where,
+        'params': where_params,
+    }
+
+
+def _property_containment(key, values):
+    matches = []
+    for value in values:
+        matches.append(value)
+        try:
+            parsed = json.loads(value)
+        except ValueError:
+            continue
+        if parsed is None or isinstance(parsed, (bool, int, long, float)):
+            matches.append(parsed)
+    clause = ' OR '.join(['gitspatial_feature.properties @> %s'] * len(matches))
+    return ('(' + clause + ')', [json.dumps({key: match}) for match in matches])
+
+
+def _property_range(key, operator, value):
+    try:
+        number = float(value)
+    except ValueError:
+        return ('gitspatial_feature.properties ->> %s {0} %s'.format(operator), [key, value])
+    if math.isnan(number) or math.isinf(number):
+        raise InvalidPropertyFilterException('Property filters must compare with a finite number')
+    # Only numbers are cast, anything else is NULL and doesn't match
+    clause = ("CASE WHEN jsonb_typeof(gitspatial_feature.properties -> %s) = 'number' "
+              "THEN (gitspatial_feature.properties ->> %s)::numeric END {0} %s").format(operator)
+    return (clause, [key, key, number])
@@ -0,0 +1,80 @@
+import math
+
+from django.contrib.gis.geos.polygon import Polygon
+from django.core.cache import get_cache
+from django.db import connection
+from django.utils.datastructures import SortedDict
+
+from gitspatial.models import Feature
+
+
+# Half the width of the Web Mercator world in meters
+world_size = 20037508.342789244
+
+# Tile coordinates run from 0 to extent, with tile_buffer units drawn outside each edge
+extent = 4096
+tile_buffer = 256
+
+max_zoom = 22
+
+# Web Mercator's latitude limit, ST_Transform to 3857 fails on the poles
+max_lat = 85.0511287798066
+
+
+def get_tile_cache():
+    return get_cache('tiles')
+
+
+def tile_cache_key(feature_set, z, x, y):
+    return 'tile:{0}:{1}:{2}/{3}/{4}'.format(feature_set.id, feature_set.generation, z, x, y)
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= max_zoom and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_bounds(z, x, y):
+    """
+    The (xmin, ymin, xmax, ymax) Web Mercator bounds of a tile
+    """
+    tile_size = 2 * world_size / 2 ** z
+    xmin = -world_size + x * tile_size
+    ymax = world_size - y * tile_size
+    return (xmin, ymax - tile_size, xmin + tile_size, ymax)
+
+
+def mercator_to_lon_lat(mx, my):
+    lon = mx / world_size * 180
+    lat = math.degrees(2 * math.atan(math.exp(my / world_size * math.pi)) - math.pi / 2)
+    return (lon, lat)
+
+
+def tile(feature_set, z, x, y):
+    """
+    A Mapbox Vector Tile of a feature set's live features, as bytes
+
+    Geometries are clipped to Web Mercator's latitude limits, then to the tile plus its
+    buffer, simplified to a tile unit and quantized to the tile's extent by PostGIS. Each
+    feature's properties become its attributes. The layer is named after the feature set.
+    """
+    xmin, ymin, xmax, ymax = tile_bounds(z, x, y)
+    margin = (xmax - xmin) * tile_buffer / extent
+    # Only features near the tile are transformed, found with the spatial index on geom
+    lon_lat_bounds = mercator_to_lon_lat(xmin - margin, max(ymin - margin, -world_size)) + \
+        mercator_to_lon_lat(xmax + margin, min(ymax + margin, world_size))
+    features = Feature.objects.live(feature_set).filter(geom__bboverlaps=Polygon.from_bbox(lon_lat_bounds)).extra(
+        select=SortedDict([
+            ('mvt_geom', 'ST_AsMVTGeom(ST_Simplify(ST_Transform(ST_ClipByBox2D(gitspatial_feature.geom, '
+                         'ST_MakeEnvelope(-180, %s, 180, %s, 4326)), 3857), %s), '
+                         'ST_MakeEnvelope(%s, %s, %s, %s, 3857), %s, %s, true)'),
+            ('attributes', 'gitspatial_feature.properties::jsonb'),
+        ]),
+        select_params=(-max_lat, max_lat, (xmax - xmin) / extent, xmin, ymin, xmax, ymax, extent, tile_buffer),
+    ).values('id', 'mvt_geom', 'attributes')
+    sql, params = features.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT ST_AsMVT(tile, %s, %s, %s, %s) FROM ({0}) AS tile WHERE tile.mvt_geom IS NOT NULL'.format(sql),
+        (feature_set.name, extent, 'mvt_geom', 'id') + tuple(params))
+    content = cursor.fetchone()[0]
+    return str(content) if content is not None else ''
@@ -1,11 +1,18 @@
 import json
 import logging
+import math
 
+from django.contrib.gis.geos.point import Point
+from django.contrib.gis.geos.polygon import Polygon
+from django.http import QueryDict
 from django.test import TestCase
 from django.test.client import Client
 
-from .exceptions import InvalidSpatialParameterException
-from .helpers import query_args
+from gitspatial.models import FeatureSet, Feature
+
+from .exceptions import InvalidCursorException, InvalidFormatException, InvalidSpatialParameterException
+from .helpers import cache, formats, query_args, tiles
+from .v1.views import serialized_features
 
 # Simma down the logs during testing
 logger = logging.getLogger('gitspatial.api.v1.views')
@@ -148,6 +155,575 @@ class PaginationMembersTest(TestCase):
         self.assertEqual(total_count, 150)
 
 
+class CursorPaginationTest(TestCase):
+    fixtures = ['gitspatial/fixtures/test_data.json']
+    url = '/api/v1/JasonSanford/mecklenburg-gis-opendata/data/polling_locations.geojson'
+
+    def setUp(self):
+        self.client = Client()
+
+    def test_pages(self):
+        ids = []
+        cursor = ''
+        while cursor is not None:
+            response = self.client.get(self.url, {'cursor': cursor, 'limit': 40})
+            json_content = json.loads(response.content)
+            self.assertEqual(json_content['total_count'], 150)
+            ids.extend(feature['id'] for feature in json_content['features'])
+            cursor = json_content['next']
+        self.assertEqual(len(ids), 150)
+        self.assertEqual(ids, sorted(ids))
+
+    def test_last_page(self):
+        json_content = json.loads(self.client.get(self.url, {'cursor': '', 'limit': 1000}).content)
+        self.assertEqual(json_content['count'], 150)
+        self.assertEqual(json_content['next'], None)
+
+    def test_stream(self):
+        first = json.loads(self.client.get(self.url, {'cursor': '', 'limit': 100}).content)
+        streamed = json.loads(''.join(self.client.get(self.url, {'cursor': '', 'limit': 100, 'stream': 'true'}).streaming_content))
+        self.assertEqual(streamed['next'], first['next'])
+
+    def test_no_next_without_cursor(self):
+        json_content = json.loads(self.client.get(self.url).content)
+        self.assertFalse('next' in json_content)
+
+    def test_bad_cursor(self):
+        response = self.client.get(self.url, {'cursor': 'lobster'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content)['message'], 'The cursor parameter must be a next value from a previous response')
+
+
+class CursorTest(TestCase):
+    def test_round_trip(self):
+        self.assertEqual(query_args.by_cursor(query_args.encode_cursor(31902)), {'id__gt': 31902})
+
+    def test_not_base64(self):
+        self.assertRaises(InvalidCursorException, query_args.by_cursor, '!!!')
+
+
+class TotalCountTest(TestCase):
+    fixtures = ['gitspatial/fixtures/test_data.json']
+    url = '/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson'
+    bbox = '-80.888,35.206,-80.799,35.270'
+
+    def setUp(self):
+        self.client = Client()
+        cache.get_api_cache().clear()
+
+    def test_stored_count(self):
+        FeatureSet.objects.filter(id=3).update(feature_count=26)
+        # The repo, the feature set, the page of features and, since the fixture has no
+        # stored fragments, their GeoJSON. No COUNT(*).
+        with self.assertNumQueries(4):
+            json_content = json.loads(self.client.get(self.url).content)
+        self.assertEqual(json_content['total_count'], 26)
+
+    def test_stored_count_not_used_with_filter(self):
+        FeatureSet.objects.filter(id=3).update(feature_count=26)
+        json_content = json.loads(self.client.get(self.url, {'bbox': self.bbox}).content)
+        self.assertEqual(json_content['total_count'], 7)
+
+    def test_no_total_count(self):
+        json_content = json.loads(self.client.get(self.url, {'bbox': self.bbox, 'total_count': 'false'}).content)
+        self.assertEqual(json_content['total_count'], None)
+        self.assertEqual(json_content['count'], 7)
+
+    def test_estimated_total_count(self):
+        json_content = json.loads(self.client.get(self.url, {'bbox': self.bbox, 'total_count': 'estimate'}).content)
+        self.assertTrue(isinstance(json_content['total_count'], int))
+
+
+class TileTest(TestCase):
+    fixtures = ['gitspatial/fixtures/test_data.json']
+    # Charlotte, NC
+    url = '/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson/tiles/8/70/101.mvt'
+
+    def setUp(self):
+        self.client = Client()
+        tiles.get_tile_cache().clear()
+
+    def test_tile(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/vnd.mapbox-vector-tile')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertTrue(len(response.content) > 0)
+
+    def test_tile_cached(self):
+        content = self.client.get(self.url).content
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.content, content)
+
+    def test_empty_tile(self):
+        response = self.client.get('/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson/tiles/10/0/0.mvt')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, '')
+
+    def test_polar_features(self):
+        # Out past Web Mercator's limits, ST_Transform can't project the poles
+        Feature.objects.create(feature_set=FeatureSet.objects.get(id=3), properties='{"name": "Arctic"}',
+                               geom=Polygon.from_bbox((-180, 60, 180, 90)))
+        response = self.client.get('/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson/tiles/0/0/0.mvt')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(len(response.content) > 0)
+
+    def test_out_of_range(self):
+        response = self.client.get('/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson/tiles/1/2/0.mvt')
+        self.assertEqual(response.status_code, 404)
+
+    def test_tile_bounds(self):
+        xmin, ymin, xmax, ymax = tiles.tile_bounds(1, 1, 0)
+        self.assertAlmostEqual(xmin, 0)
+        self.assertAlmostEqual(ymin, 0)
+        self.assertAlmostEqual(xmax, tiles.world_size)
+        self.assertAlmostEqual(ymax, tiles.world_size)
+
+    def test_mercator_to_lon_lat(self):
+        lon, lat = tiles.mercator_to_lon_lat(tiles.world_size, tiles.world_size)
+        self.assertAlmostEqual(lon, 180)
+        self.assertAlmostEqual(lat, 85.0511287798, places=6)
+
+
+class SimplificationTest(TestCase):
+    fixtures = ['gitspatial/fixtures/test_data.json']
+    url = '/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson'
+
+    def setUp(self):
+        self.client = Client()
+
+    def test_precision(self):
+        json_content = json.loads(self.client.get(self.url, {'precision': 2}).content)
+        self.assertEqual(len(json_content['features']), 26)
+        for coordinate in json_content['features'][0]['geometry']['coordinates']:
+            self.assertEqual(round(coordinate, 2), coordinate)
+
+    def test_zoom(self):
+        json_content = json.loads(self.client.get(self.url, {'zoom': 8}).content)
+        # Nothing simplified is stored in the fixture, full resolution geometries are used instead
+        self.assertEqual(len(json_content['features']), 26)
+        self.assertEqual(json_content['features'][0]['geometry']['type'], 'Point')
+
+    def test_bad_precision(self):
+        response = self.client.get(self.url, {'precision': 16})
+        self.assertEqual(response.status_code, 400)
+
+    def test_simplified_geom(self):
+        self.assertEqual(query_args.simplified_geom(), 'geom')
+        self.assertEqual(query_args.simplified_geom(simplify='0.005'), 'geom_100m')
+        self.assertEqual(query_args.simplified_geom(simplify='0.00001'), 'geom')
+        self.assertEqual(query_args.simplified_geom(zoom='6'), 'geom_1km')
+        self.assertEqual(query_args.simplified_geom(zoom='10'), 'geom_100m')
+        self.assertEqual(query_args.simplified_geom(zoom='16'), 'geom')
+        self.assertEqual(query_args.simplified_geom(simplify='0.0002', zoom='6'), 'geom_10m')
+
+    def test_simplified_geom_not_floatable(self):
+        self.assertRaises(InvalidSpatialParameterException, query_args.simplified_geom, simplify='lobster')
+
+
+class OutputFormatTest(TestCase):
+    fixtures = ['gitspatial/fixtures/test_data.json']
+    url = '/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson'
+
+    def setUp(self):
+        self.client = Client()
+
+    def test_flatgeobuf(self):
+        response = self.client.get(self.url, {'format': 'flatgeobuf', 'callback': 'myFunc'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/flatgeobuf')
+        # FlatGeobuf's magic bytes
+        self.assertEqual(response.content[:3], 'fgb')
+
+    def test_geobuf_by_accept(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='application/x-protobuf')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-protobuf')
+        self.assertTrue('Accept' in response['Vary'])
+
+    def test_binary_pages_by_cursor(self):
+        pages = []
+        cursor = ''
+        while cursor is not None:
+            response = self.client.get(self.url, {'format': 'geobuf', 'cursor': cursor, 'limit': 10})
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.content)
+            cursor = response['X-Next-Cursor'] if response.has_header('X-Next-Cursor') else None
+        # 26 colleges, the last page is short
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(len(set(pages)), 3)
+
+    def test_binary_pages_by_offset_are_stable(self):
+        first = self.client.get(self.url, {'format': 'geobuf', 'limit': 10, 'offset': 10}).content
+        second = self.client.get(self.url, {'format': 'geobuf', 'limit': 10, 'offset': 10}).content
+        self.assertEqual(first, second)
+        self.assertFalse(self.client.get(self.url, {'format': 'geobuf', 'limit': 10}).has_header('X-Next-Cursor'))
+
+    def test_etag_depends_on_accept(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_ACCEPT='application/flatgeobuf', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_bad_format(self):
+        response = self.client.get(self.url, {'format': 'shapefile'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_output_format(self):
+        self.assertEqual(formats.output_format(), 'geojson')
+        self.assertEqual(formats.output_format('geobuf', 'application/flatgeobuf'), 'geobuf')
+        self.assertEqual(formats.output_format(accept='text/html, application/flatgeobuf;q=0.9'), 'flatgeobuf')
+        self.assertEqual(formats.output_format(accept='*/*'), 'geojson')
+        self.assertRaises(InvalidFormatException, formats.output_format, 'kml')
+
+
+class NearestTest(TestCase):
+    fixtures = ['gitspatial/fixtures/test_data.json']
+    url = '/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson'
+
+    def setUp(self):
+        self.client = Client()
+
+    def distances(self, json_content, lat, lon):
+        # Haversine distances in meters
+        distances = []
+        for feature in json_content['features']:
+            feature_lon, feature_lat = feature['geometry']['coordinates']
+            dlat = math.radians(feature_lat - lat)
+            dlon = math.radians(feature_lon - lon)
+            a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat)) * math.cos(math.radians(feature_lat)) * math.sin(dlon / 2) ** 2
+            distances.append(2 * 6371008.8 * math.asin(math.sqrt(a)))
+        return distances
+
+    def test_nearest(self):
+        json_content = json.loads(self.client.get(self.url, {'lat': 35.256, 'lon': -80.809, 'nearest': 3}).content)
+        self.assertEqual(json_content['count'], 3)
+        distances = self.distances(json_content, 35.256, -80.809)
+        self.assertEqual(distances, sorted(distances))
+
+        everything = json.loads(self.client.get(self.url).content)
+        self.assertEqual(distances, sorted(self.distances(everything, 35.256, -80.809))[:3])
+
+    def test_nearest_in_meters_at_high_latitude(self):
+        feature_set = FeatureSet.objects.get(id=19)
+        # Nearer in degrees, but a degree of longitude is half as long at 60N
+        for i in range(4):
+            Feature.objects.create(feature_set=feature_set, properties='{"name": "North %s"}' % i,
+                                   geom=Point(x=10, y=60.0100 + i * 0.0001, srid=4326))
+        Feature.objects.create(feature_set=feature_set, properties='{"name": "East"}', geom=Point(x=10.019, y=60, srid=4326))
+
+        json_content = json.loads(self.client.get('/api/v1/SalParadise/bike_stuff/bike_shops.geojson',
+                                                  {'lat': 60, 'lon': 10, 'nearest': 1}).content)
+        self.assertEqual(json_content['features'][0]['properties'], {'name': 'East'})
+        json_content = json.loads(self.client.get('/api/v1/SalParadise/bike_stuff/bike_shops.geojson',
+                                                  {'lat': 60, 'lon': 10, 'nearest': 3}).content)
+        distances = self.distances(json_content, 60, 10)
+        self.assertEqual(distances, sorted(distances))
+        self.assertEqual([feature['properties']['name'] for feature in json_content['features']], ['East', 'North 0', 'North 1'])
+
+    def test_nearest_within_distance(self):
+        json_content = json.loads(self.client.get(self.url, {'lat': 35.256, 'lon': -80.809, 'distance': 1, 'nearest': 3}).content)
+        self.assertEqual(json_content['count'], 0)
+
+    def test_nearest_bad_parameters(self):
+        response = self.client.get(self.url, {'lat': 35.256, 'lon': -80.809, 'nearest': 'lobster'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(self.url, {'lat': 35.256, 'nearest': 3})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content)['message'], 'Parameters lat and lon must be parseable as floats when using nearest')
+
+
+class GeometryQueryTest(TestCase):
+    fixtures = ['gitspatial/fixtures/test_data.json']
+    url = '/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson'
+    polygon = {
+        'type': 'Polygon',
+        'coordinates': [[[-80.888, 35.206], [-80.799, 35.206], [-80.799, 35.270], [-80.888, 35.270], [-80.888, 35.206]]],
+    }
+
+    def setUp(self):
+        self.client = Client()
+        cache.get_api_cache().clear()
+
+    def post(self, query, url=None):
+        return self.client.post(url or self.url, json.dumps(query), content_type='application/json')
+
+    def test_intersects(self):
+        response = self.post({'geometry': self.polygon})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['features']), 7)
+
+    def test_within(self):
+        response = self.post({'geometry': self.polygon, 'predicate': 'within'})
+        self.assertEqual(len(json.loads(response.content)['features']), 7)
+
+    def test_contains(self):
+        response = self.post({'geometry': self.polygon, 'predicate': 'contains'})
+        self.assertEqual(len(json.loads(response.content)['features']), 0)
+
+    def test_cached_by_geometry(self):
+        self.post({'geometry': self.polygon})
+        self.assertEqual(self.post({'geometry': self.polygon})['X-Cache'], 'HIT')
+        response = self.post({'geometry': self.polygon, 'predicate': 'contains'})
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(json.loads(response.content)['features']), 0)
+
+    def test_conditional_headers_ignored(self):
+        body = json.dumps({'geometry': self.polygon})
+        response = self.client.post(self.url, body, content_type='application/json', HTTP_IF_MATCH='*')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Last-Modified'))
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.post(self.url, body, content_type='application/json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_query_arguments(self):
+        response = self.post({'geometry': self.polygon}, url=self.url + '?limit=2')
+        self.assertEqual(len(json.loads(response.content)['features']), 2)
+
+    def test_bad_body(self):
+        response = self.post({'geometry': {'type': 'Polygon', 'coordinates': 'lobster'}})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content)['message'], 'The geometry must be a valid GeoJSON geometry')
+        response = self.post({'geometry': self.polygon, 'predicate': 'touches'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(self.url, 'lobster', content_type='application/json')
+        self.assertEqual(json.loads(response.content)['message'], 'The request body must be JSON')
+
+
+class PropertyFilterTest(TestCase):
+    fixtures = ['gitspatial/fixtures/test_data.json']
+    url = '/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson'
+
+    def setUp(self):
+        self.client = Client()
+
+    def get(self, params):
+        return json.loads(self.client.get(self.url, params).content)
+
+    def test_equals(self):
+        json_content = self.get({'prop.zipcode': '28207'})
+        self.assertEqual(json_content['count'], 3)
+        self.assertEqual(json_content['total_count'], 3)
+        json_content = self.get({'prop.name': 'Davidson'})
+        self.assertEqual([feature['properties']['name'] for feature in json_content['features']], ['Davidson'])
+
+    def test_in(self):
+        self.assertEqual(self.get({'prop.zipcode__in': '28207,28209,99999'})['count'], 6)
+
+    def test_range(self):
+        self.assertEqual(self.get({'prop.zipcode__gte': '28210'})['count'], 11)
+        self.assertEqual(self.get({'prop.zipcode__lt': '28210'})['count'], 15)
+        self.assertEqual(self.get({'prop.zipcode__gt': '28200', 'prop.zipcode__lte': '28204'})['count'], 4)
+
+    def test_with_bbox(self):
+        json_content = self.get({'prop.zipcode__gte': '28000', 'bbox': '-80.888,35.206,-80.799,35.270'})
+        self.assertEqual(json_content['total_count'], 7)
+
+    def test_stored_count_not_used(self):
+        FeatureSet.objects.filter(id=3).update(feature_count=26)
+        self.assertEqual(self.get({'prop.zipcode': '28207'})['total_count'], 3)
+
+    def test_no_key(self):
+        response = self.client.get(self.url, {'prop.': 'lobster'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_by_properties(self):
+        self.assertEqual(query_args.by_properties(QueryDict('bbox=1,2,3,4')), None)
+        property_args = query_args.by_properties(QueryDict('prop.zipcode=28207'))
+        self.assertEqual(property_args['params'], ['{"zipcode": "28207"}', '{"zipcode": 28207}'])
+
+
+class ClusterTest(TestCase):
+    fixtures = ['gitspatial/fixtures/test_data.json']
+    url = '/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson'
+
+    def setUp(self):
+        self.client = Client()
+        cache.get_api_cache().clear()
+
+    def test_grid(self):
+        json_content = json.loads(self.client.get(self.url, {'cluster': 'grid', 'cell': 10}).content)
+        self.assertEqual(json_content['count'], 1)
+        self.assertEqual(json_content['total_count'], 26)
+        cluster = json_content['features'][0]
+        self.assertEqual(cluster['properties'], {'count': 26, 'bbox': [-90, 30, -80, 40]})
+        self.assertEqual(cluster['geometry']['type'], 'Point')
+
+    def test_grid_with_bbox(self):
+        json_content = json.loads(self.client.get(self.url, {'cluster': 'grid', 'bbox': '-80.888,35.206,-80.799,35.270'}).content)
+        self.assertEqual(json_content['total_count'], 7)
+
+    def test_total_count_includes_cells_left_out(self):
+        with self.settings(API_CLUSTER_MAX_CELLS=1):
+            json_content = json.loads(self.client.get(self.url, {'cluster': 'grid', 'cell': 0.01}).content)
+        self.assertEqual(json_content['count'], 1)
+        self.assertEqual(json_content['total_count'], 26)
+        self.assertTrue(json_content['features'][0]['properties']['count'] < 26)
+
+    def test_geohash(self):
+        json_content = json.loads(self.client.get(self.url, {'cluster': 'geohash', 'cell': 1}).content)
+        self.assertEqual(json_content['count'], 1)
+        self.assertEqual(json_content['features'][0]['properties'], {'count': 26, 'geohash': 'd'})
+
+    def test_unsupported_combinations(self):
+        response = self.client.get(self.url, {'cluster': 'grid', 'format': 'flatgeobuf'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content)['message'], 'Clusters are only available as GeoJSON')
+        response = self.client.get(self.url, {'cluster': 'grid'}, HTTP_ACCEPT='application/x-protobuf')
+        self.assertEqual(response.status_code, 400)
+        for param in ('stream', 'simplify', 'zoom', 'precision'):
+            response = self.client.get(self.url, {'cluster': 'grid', param: '1'})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(json.loads(response.content)['message'], 'The {0} parameter can\'t be used with cluster'.format(param))
+
+    def test_bad_cluster(self):
+        response = self.client.get(self.url, {'cluster': 'hexagon'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(self.url, {'cluster': 'geohash', 'cell': 13})
+        self.assertEqual(response.status_code, 400)
+
+
+class SerializedFeaturesTest(TestCase):
+    fixtures = ['gitspatial/fixtures/test_data.json']
+
+    def test_stored_fragment(self):
+        fragment = json.dumps({'type': 'Feature', 'properties': {'name': 'Shop'}, 'geometry': {'type': 'Point', 'coordinates': [-80.8, 35.2]}})
+        json_features = serialized_features([(42, fragment)])
+        self.assertEqual(json.loads(json_features[0]), {
+            'type': 'Feature',
+            'id': 42,
+            'properties': {'name': 'Shop'},
+            'geometry': {'type': 'Point', 'coordinates': [-80.8, 35.2]},
+        })
+
+    def test_missing_fragment(self):
+        feature = Feature.objects.filter(feature_set_id=3)[0]
+        json_features = serialized_features([(feature.id, '')])
+        feature_json = json.loads(json_features[0])
+        self.assertEqual(feature_json['id'], feature.id)
+        self.assertEqual(feature_json['properties'], json.loads(feature.properties))
+        self.assertEqual(feature_json['geometry']['type'], feature.geom.geom_type)
+
+
+class StreamingTest(TestCase):
+    fixtures = ['gitspatial/fixtures/test_data.json']
+    url = '/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson'
+
+    def setUp(self):
+        self.client = Client()
+        cache.get_api_cache().clear()
+        cache.get_api_stats_cache().clear()
+
+    def test_stream(self):
+        response = self.client.get(self.url + '?stream=true')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        json_content = json.loads(''.join(response.streaming_content))
+        self.assertEqual(len(json_content['features']), 26)
+        self.assertEqual(json_content['count'], 26)
+        self.assertEqual(json_content['total_count'], 26)
+
+    def test_stream_matches_buffered(self):
+        with self.settings(FEATURE_SET_BATCH_SIZE=5):
+            streamed = json.loads(''.join(self.client.get(self.url + '?stream=true&limit=12&offset=3').streaming_content))
+        buffered = json.loads(self.client.get(self.url + '?limit=12&offset=3').content)
+        self.assertEqual(streamed, buffered)
+
+    def test_stream_jsonp(self):
+        response = self.client.get(self.url + '?stream=true&callback=myFunc')
+        self.assertEqual(response['Content-Type'], 'text/javascript')
+        content = ''.join(response.streaming_content)
+        self.assertEqual(content[:7], 'myFunc(')
+        self.assertEqual(content[-1], ')')
+
+    def test_stream_not_cached(self):
+        self.client.get(self.url + '?stream=true')
+        self.assertEqual(cache.cache_stats(), {'hits': 0, 'misses': 0})
+
+
+class ResponseCacheTest(TestCase):
+    fixtures = ['gitspatial/fixtures/test_data.json']
+
+    def setUp(self):
+        self.client = Client()
+        cache.get_api_cache().clear()
+        cache.get_api_stats_cache().clear()
+
+    def test_repeat_request_is_cached(self):
+        url = '/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson?bbox=-80.888,35.206,-80.799,35.270'
+        first = self.client.get(url)
+        second = self.client.get(url)
+        self.assertEqual(first['X-Cache'], 'MISS')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(cache.cache_stats(), {'hits': 1, 'misses': 1})
+
+    def test_stats_survive_evicted_responses(self):
+        url = '/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson'
+        self.client.get(url)
+        self.client.get(url)
+        cache.get_api_cache().clear()
+        self.assertEqual(cache.cache_stats(), {'hits': 1, 'misses': 1})
+
+    def test_new_generation_invalidates(self):
+        url = '/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson'
+        self.client.get(url)
+        FeatureSet.objects.filter(id=3).update(generation=1)
+        response = self.client.get(url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+
+    def test_query_order_does_not_matter(self):
+        self.client.get('/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson?limit=5&offset=2')
+        response = self.client.get('/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson?offset=2&limit=5')
+        self.assertEqual(response['X-Cache'], 'HIT')
+
+    def test_jsonp_shares_cache(self):
+        self.client.get('/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson?limit=5')
+        response = self.client.get('/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson?limit=5&callback=myFunc')
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.content[:7], 'myFunc(')
+
+
+class ConditionalRequestTest(TestCase):
+    fixtures = ['gitspatial/fixtures/test_data.json']
+    url = '/api/v1/JasonSanford/mecklenburg-gis-opendata/data/colleges.geojson?bbox=-80.888,35.206,-80.799,35.270'
+
+    def setUp(self):
+        self.client = Client()
+
+    def test_etag_and_last_modified(self):
+        response = self.client.get(self.url)
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertTrue('Last-Modified' in response)
+
+    def test_if_none_match(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+    def test_etag_changes_with_generation(self):
+        etag = self.client.get(self.url)['ETag']
+        FeatureSet.objects.filter(id=3).update(generation=1)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_changes_with_query(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url + '&limit=2', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_jsonp_not_modified(self):
+        etag = self.client.get(self.url + '&callback=myFunc')['ETag']
+        response = self.client.get(self.url + '&callback=myFunc', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+
 class HttpMethodTest(TestCase):
     fixtures = ['gitspatial/fixtures/test_data.json']
 
@@ -163,8 +739,9 @@ class HttpMethodTest(TestCase):
         self.assertEqual(response.status_code, 405)
 
     def test_post(self):
+        # POSTs are geometry queries, this one has no geometry
         response = self.client.post('/api/v1/JasonSanford/mecklenburg-gis-opendata/data/polling_locations.geojson')
-        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response.status_code, 400)
 
     def test_delete(self):
         response = self.client.delete('/api/v1/JasonSanford/mecklenburg-gis-opendata/data/polling_locations.geojson')
@@ -193,3 +770,26 @@ class BBoxTest(TestCase):
             pass
         self.assertTrue(isinstance(exc, InvalidSpatialParameterException))
         self.assertEqual(str(exc), 'Items in the bbox parameter must be parseable as floats')
+
+
+class DistanceTest(TestCase):
+    def test_bbox_prefilter(self):
+        distance_args = query_args.by_lat_lon_distance('35.256', '-80.809', '4000')
+        self.assertTrue('geom__distance_lte' in distance_args)
+        xmin, ymin, xmax, ymax = distance_args['geom__bboverlaps'].extent
+        self.assertTrue(xmin < -80.809 < xmax)
+        self.assertTrue(ymin < 35.256 < ymax)
+
+    def test_bbox_holds_distance(self):
+        xmin, ymin, xmax, ymax = query_args.distance_bbox(60.0, 10.0, 10000)
+        # 10km north and east, at 60 degrees north a degree of longitude is half as long
+        self.assertTrue(ymax - 60.0 > 10000 / 111700.0)
+        self.assertTrue(xmax - 10.0 > 10000 / (111320.0 * 0.5))
+
+    def test_no_bbox_across_antimeridian(self):
+        self.assertEqual(query_args.distance_bbox(0, 179.99, 10000), None)
+        distance_args = query_args.by_lat_lon_distance('0', '179.99', '10000')
+        self.assertFalse('geom__bboverlaps' in distance_args)
+
+    def test_no_bbox_across_pole(self):
+        self.assertEqual(query_args.distance_bbox(89.99, 0, 10000), None)
@@ -1,17 +1,21 @@
+import hashlib
 import json
 import logging
+import uuid
 
 from django.conf import settings
-from django.http import Http404, HttpResponse, HttpResponseBadRequest
+from django.db import connection
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_GET, require_POST
+from django.views.decorators.http import condition, require_GET, require_http_methods, require_POST
+from django.views.decorators.vary import vary_on_headers
 
 from gitspatial.models import Repo, FeatureSet, Feature
-from ..decorators import jsonp
-from ..exceptions import InvalidSpatialParameterException
-from ..helpers import query_args
-from ...tasks import get_feature_set_features, get_repo_feature_sets
+from ..decorators import condition_on_get, jsonp
+from ..exceptions import InvalidCursorException, InvalidFormatException, InvalidPropertyFilterException, InvalidSpatialParameterException
+from ..helpers import cache, clusters, formats, query_args, tiles
+from ...tasks import get_repo_feature_sets, schedule_feature_set_sync, HOOK_SYNC_QUEUE
 
 
 default_limit = 1000
@@ -23,41 +27,104 @@ def docs(request):
     return render(request, 'api_v1.html')
 
 
+def get_feature_set(request, user_name, repo_name, feature_set_name):
+    """
+    The synced feature set a query is for, looked up once per request, or None if there isn't one
+    """
+    if not hasattr(request, '_feature_set'):
+        full_name = '{0}/{1}'.format(user_name, repo_name)
+        try:
+            repo = Repo.objects.get(full_name=full_name)
+            feature_set = FeatureSet.objects.get(repo=repo, name=feature_set_name)
+        except (Repo.DoesNotExist, FeatureSet.DoesNotExist):
+            feature_set = None
+        if feature_set is not None and not feature_set.synced:
+            feature_set = None
+        request._feature_set = feature_set
+    return request._feature_set
+
+
+def feature_set_query_etag(request, *args, **kwargs):
+    feature_set = get_feature_set(request, *args, **kwargs)
+    if feature_set is None:
+        return None
+    try:
+        output_format = formats.output_format(request.GET.get('format'), request.META.get('HTTP_ACCEPT', ''))
+    except InvalidFormatException:
+        output_format = None
+    return cache.query_etag(feature_set, request.GET, output_format)
+
+
+def request_body_hash(request):
+    """
+    A tuple with the SHA-1 of a POST request's body, empty for anything else
+    """
+    if request.method != 'POST':
+        return ()
+    return (hashlib.sha1(request.body).hexdigest(),)
+
+
+def feature_set_query_last_modified(request, *args, **kwargs):
+    feature_set = get_feature_set(request, *args, **kwargs)
+    if feature_set is None:
+        return None
+    return feature_set.updated_date
+
+
+@csrf_exempt
 @jsonp
-@require_GET
+@require_http_methods(['GET', 'POST'])
+@vary_on_headers('Accept')
+@condition_on_get(etag_func=feature_set_query_etag, last_modified_func=feature_set_query_last_modified)
 def feature_set_query(request, user_name, repo_name, feature_set_name):
     logger.info('[api]: URL: {0}'.format(request.path))
-    full_name = '{0}/{1}'.format(user_name, repo_name)
-    try:
-        repo = Repo.objects.get(full_name=full_name)
-        feature_set = FeatureSet.objects.get(repo=repo, name=feature_set_name)
-    except (Repo.DoesNotExist, FeatureSet.DoesNotExist):
+    feature_set = get_feature_set(request, user_name, repo_name, feature_set_name)
+    if feature_set is None:
         raise Http404
 
-    if not feature_set.synced:
-        raise Http404
+    try:
+        output_format = formats.output_format(request.GET.get('format'), request.META.get('HTTP_ACCEPT', ''))
+    except InvalidFormatException as ex:
+        return bad_request(str(ex))
+
+    # Streamed and binary responses can be much larger, they skip the response cache
+    stream = request.GET.get('stream') == 'true'
+    bulk = stream or output_format != 'geojson'
+    max_limit = settings.API_STREAM_MAX_LIMIT if bulk else default_limit
 
-    limit = request.GET.get('limit', default_limit)
+    if not bulk:
+        cache_key = cache.query_cache_key(feature_set, request.GET, *request_body_hash(request))
+        content = cache.get_cached_query(cache_key)
+        if content is not None:
+            logger.debug('[api]: Cache hit, {0}'.format(cache.cache_stats()))
+            response = HttpResponse(content, content_type='application/json')
+            response['X-Cache'] = 'HIT'
+            return response
+
+    limit = request.GET.get('limit', max_limit)
     offset = request.GET.get('offset', 0)
 
     try:
         limit = int(limit)
     except ValueError:
-        limit = default_limit
-    if limit > default_limit:
-        limit = default_limit
+        limit = max_limit
+    if limit > max_limit:
+        limit = max_limit
 
     try:
         offset = int(offset)
     except ValueError:
         offset = 0
 
-    filter_kwargs = {
-        'feature_set': feature_set,
-    }
+    filter_kwargs = {}
     spatial_args = None
 
-    if 'bbox' in request.GET:
+    if request.method == 'POST':
+        try:
+            spatial_args = query_args.by_geometry(request.body)
+        except InvalidSpatialParameterException as ex:
+            return bad_request(str(ex))
+    elif 'bbox' in request.GET:
         try:
             spatial_args = query_args.by_bbox(request.GET['bbox'])
         except InvalidSpatialParameterException as ex:
@@ -71,22 +138,261 @@ def feature_set_query(request, user_name, repo_name, feature_set_name):
     if spatial_args is not None:
         filter_kwargs.update(spatial_args)
 
-    total_count = Feature.objects.filter(**filter_kwargs).count()
-
-    features = Feature.objects.filter(**filter_kwargs).geojson()[offset:offset+limit]
-    json_features = [
-        {
-            'type': 'Feature',
-            'properties': json.loads(feature.properties),
-            'geometry': json.loads(feature.geojson),
-            'id': feature.id,
-        } for feature in features
-    ]
-    response = {'type': 'FeatureCollection', 'features': json_features, 'count': len(features), 'total_count': total_count}
-    indent = 2 if settings.DEBUG else None
-    content = json.dumps(response, indent=indent)
+    try:
+        property_args = query_args.by_properties(request.GET)
+    except InvalidPropertyFilterException as ex:
+        return bad_request(str(ex))
 
-    return HttpResponse(content, content_type='application/json')
+    matching = Feature.objects.live(feature_set).filter(**filter_kwargs)
+    if property_args is not None:
+        matching = matching.extra(**property_args)
+    filtered = bool(filter_kwargs) or property_args is not None
+
+    # Closest first instead of by id, with the same filters
+    nearest_args = None
+    if 'nearest' in request.GET:
+        try:
+            nearest_args = query_args.by_nearest(request.GET.get('lat'), request.GET.get('lon'), request.GET['nearest'])
+        except InvalidSpatialParameterException as ex:
+            return bad_request(str(ex))
+        limit = min(int(request.GET['nearest']), max_limit)
+
+    if 'cluster' in request.GET:
+        try:
+            method, cell = clusters.cluster_args(request.GET['cluster'], request.GET.get('cell'))
+        except InvalidSpatialParameterException as ex:
+            return bad_request(str(ex))
+        if output_format != 'geojson':
+            return bad_request('Clusters are only available as GeoJSON')
+        unsupported = [param for param in clusters.unsupported_params if param in request.GET]
+        if unsupported:
+            return bad_request('The {0} parameter can\'t be used with cluster'.format(unsupported[0]))
+        cluster_features, total_count = clusters.clusters(matching, method, cell)
+        response = {
+            'type': 'FeatureCollection',
+            'features': cluster_features,
+            'count': len(cluster_features),
+            'total_count': total_count,
+        }
+        indent = 2 if settings.DEBUG else None
+        return cached_json_response(cache_key, json.dumps(response, indent=indent))
+
+    geom_field = 'geom'
+    precision = None
+    try:
+        geom_field = query_args.simplified_geom(request.GET.get('simplify'), request.GET.get('zoom'))
+        if 'precision' in request.GET:
+            precision = query_args.geometry_precision(request.GET['precision'])
+    except InvalidSpatialParameterException as ex:
+        return bad_request(str(ex))
+
+    # With a cursor, even an empty one, pages are fetched by id instead of by offset
+    paginate_by_cursor = 'cursor' in request.GET and nearest_args is None
+    cursor_args = {}
+    if request.GET.get('cursor'):
+        try:
+            cursor_args = query_args.by_cursor(request.GET['cursor'])
+        except InvalidCursorException as ex:
+            return bad_request(str(ex))
+
+    features = matching
+    # Columns selected only to order by, which follow the ones the serializers use
+    order_fields = ()
+    # Sliced last since extra() can't be used on a sliced queryset
+    page = slice(offset, offset + limit)
+    if nearest_args is not None:
+        features = query_args.nearest_features(matching, nearest_args, offset + limit).extra(**nearest_args)
+        order_fields = tuple(nearest_args['select'])
+    elif paginate_by_cursor:
+        features = features.filter(**cursor_args).order_by('id')
+        page = slice(None, limit)
+
+    if output_format != 'geojson':
+        if nearest_args is None and not paginate_by_cursor:
+            # Binary responses are for bulk pulls, whose offset pages have to line up
+            features = features.order_by('id')
+        content, count, last_id = formats.encoded_features(features, page, output_format, order_fields)
+        response = HttpResponse(content, content_type=formats.media_types[output_format])
+        if paginate_by_cursor and count == limit:
+            # No room for a next member in the body, so it's a header instead
+            response['X-Next-Cursor'] = query_args.encode_cursor(last_id)
+        return response
+
+    total_count = feature_set_total_count(feature_set, matching, filtered, request.GET.get('total_count'))
+
+    if geom_field == 'geom' and precision is None:
+        rows = features.values_list('id', 'feature_json', *order_fields)[page]
+        serialize = serialized_features
+    else:
+        # Simplified or rounded geometries can't use the stored GeoJSON
+        rows = features.extra(
+            select={'geometry_json': 'ST_AsGeoJSON(COALESCE(gitspatial_feature.{0}, gitspatial_feature.geom), %s)'.format(geom_field)},
+            select_params=(15 if precision is None else precision,),
+        ).values_list('id', 'properties', 'geometry_json', *order_fields)[page]
+        serialize = assembled_features
+    if stream:
+        return StreamingHttpResponse(stream_feature_collection(rows, serialize, total_count, limit if paginate_by_cursor else None),
+                                     content_type='application/json')
+    rows = list(rows)
+    json_features = serialize(rows)
+    members = {'count': len(json_features), 'total_count': total_count}
+    if paginate_by_cursor:
+        members['next'] = next_cursor(rows, limit)
+    content = '{"type": "FeatureCollection", "features": [' + ', '.join(json_features) + feature_collection_end(members)
+    return cached_json_response(cache_key, content)
+
+
+def cached_json_response(cache_key, content):
+    """
+    A JSON response for a query the cache missed, caching its content for next time
+    """
+    cache.set_cached_query(cache_key, content)
+    response = HttpResponse(content, content_type='application/json')
+    response['X-Cache'] = 'MISS'
+    return response
+
+
+def feature_set_total_count(feature_set, features, filtered, mode=None):
+    """
+    How many of a feature set's features match a query, or None if mode is "false"
+
+    Unfiltered queries use the count stored when the feature set was synced. Filtered
+    ones are counted, or estimated by the query planner if mode is "estimate".
+    """
+    if mode == 'false':
+        return None
+    if not filtered and feature_set.feature_count is not None:
+        return feature_set.feature_count
+    if mode == 'estimate':
+        return estimated_count(features)
+    return features.count()
+
+
+def estimated_count(queryset):
+    """
+    The number of rows PostgreSQL's planner expects a queryset to return
+    """
+    sql, params = queryset.values('id').query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+    plan = cursor.fetchone()[0]
+    # psycopg2 only parses json columns itself when it knows the type
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def feature_set_tile_etag(request, user_name, repo_name, feature_set_name, z, x, y):
+    feature_set = get_feature_set(request, user_name, repo_name, feature_set_name)
+    if feature_set is None:
+        return None
+    return tiles.tile_cache_key(feature_set, z, x, y)
+
+
+@require_GET
+@condition(etag_func=feature_set_tile_etag, last_modified_func=feature_set_query_last_modified)
+def feature_set_tile(request, user_name, repo_name, feature_set_name, z, x, y):
+    feature_set = get_feature_set(request, user_name, repo_name, feature_set_name)
+    z, x, y = int(z), int(x), int(y)
+    if feature_set is None or not tiles.valid_tile(z, x, y):
+        raise Http404
+
+    tile_cache = tiles.get_tile_cache()
+    cache_key = tiles.tile_cache_key(feature_set, z, x, y)
+    content = tile_cache.get(cache_key)
+    if content is None:
+        content = tiles.tile(feature_set, z, x, y)
+        tile_cache.set(cache_key, content)
+        x_cache = 'MISS'
+    else:
+        x_cache = 'HIT'
+
+    response = HttpResponse(content, content_type='application/vnd.mapbox-vector-tile')
+    response['X-Cache'] = x_cache
+    return response
+
+
+def feature_collection_end(members):
+    """
+    The end of a FeatureCollection following its features, with a dict of extra members
+    """
+    return '], ' + json.dumps(members)[1:]
+
+
+def next_cursor(rows, limit):
+    """
+    The cursor for the page after a page of (id, ...) rows, or None if it was the last one
+    """
+    if not rows or len(rows) < limit:
+        return None
+    return query_args.encode_cursor(rows[-1][0])
+
+
+def serialized_features(rows):
+    """
+    GeoJSON strings for (id, feature_json) rows, in order
+
+    The id is spliced into the fragment stored at sync time so nothing is parsed or
+    re-serialized. Features synced before fragments were stored are serialized here.
+    """
+    rows = [row[:2] for row in rows]
+    missing = [feature_id for feature_id, feature_json in rows if not feature_json]
+    if missing:
+        fallback = dict(
+            (feature.id, json.dumps({
+                'type': 'Feature',
+                'properties': json.loads(feature.properties),
+                'geometry': json.loads(feature.geojson),
+            })) for feature in Feature.objects.filter(id__in=missing).geojson()
+        )
+    json_features = []
+    for feature_id, feature_json in rows:
+        if not feature_json:
+            feature_json = fallback[feature_id]
+        json_features.append('{{"id": {0}, {1}'.format(feature_id, feature_json[1:]))
+    return json_features
+
+
+def assembled_features(rows):
+    """
+    GeoJSON strings for (id, properties, geometry GeoJSON) rows, in order
+    """
+    return ['{{"type": "Feature", "id": {0}, "properties": {1}, "geometry": {2}}}'.format(*row[:3]) for row in rows]
+
+
+def stream_feature_collection(rows_queryset, serialize, total_count, cursor_limit=None):
+    """
+    Yield a FeatureCollection for a values_list queryset of features piece by piece
+
+    serialize turns a batch of rows into GeoJSON strings, see serialized_features.
+
+    Rows are read through a PostgreSQL server-side cursor, FEATURE_SET_BATCH_SIZE at
+    a time, so neither the database driver nor the view hold the whole result in
+    memory. count comes after the features since it isn't known until the end.
+    When paginating by cursor, cursor_limit is the page size and next is included.
+    """
+    sql, params = rows_queryset.query.sql_with_params()
+    # Named cursors live on the underlying psycopg2 connection, make sure it's open
+    connection.cursor()
+    cursor = connection.connection.cursor(name='feature_set_query_{0}'.format(uuid.uuid4().hex))
+    try:
+        cursor.execute(sql, params)
+        yield '{"type": "FeatureCollection", "features": ['
+        count = 0
+        while True:
+            rows = cursor.fetchmany(settings.FEATURE_SET_BATCH_SIZE)
+            if not rows:
+                break
+            json_features = serialize(rows)
+            yield (', ' if count else '') + ', '.join(json_features)
+            count += len(json_features)
+            last_id = rows[-1][0]
+        members = {'count': count, 'total_count': total_count}
+        if cursor_limit is not None:
+            members['next'] = query_args.encode_cursor(last_id) if count and count == cursor_limit else None
+        yield feature_collection_end(members)
+    finally:
+        cursor.close()
 
 
 @require_POST
@@ -112,7 +418,7 @@ def repo_hook(request, repo_id):
             try:
                 feature_set = FeatureSet.objects.get(repo=repo, path=path)
                 logger.info('[github_hook]: Getting features for {0}'.format(feature_set))
-                get_feature_set_features.apply_async((feature_set,))
+                schedule_feature_set_sync(feature_set, queue=HOOK_SYNC_QUEUE)
             except FeatureSet.DoesNotExist:
                 pass
 
@@ -123,7 +429,7 @@ def repo_hook(request, repo_id):
                 feature_set.delete()
 
         if added:
-            get_repo_feature_sets.apply_async((repo, False,))
+            get_repo_feature_sets.apply_async((repo.id, False), queue=HOOK_SYNC_QUEUE)
 
     return HttpResponse('Thanks GitHub!')
 
@@ -0,0 +1,89 @@
+import logging
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class BlobCache(object):
+    """
+    An on-disk cache of raw GeoJSON files keyed by their git blob SHA
+
+    Blobs are immutable, so entries never go stale. Opening an entry touches its
+    modification time and the least recently used entries are evicted once the
+    cache grows past max_size bytes.
+    """
+
+    def __init__(self, directory=None, max_size=None):
+        self.directory = directory or settings.BLOB_CACHE_DIR
+        self.max_size = settings.BLOB_CACHE_MAX_SIZE if max_size is None else max_size
+
+    def path(self, sha):
+        return os.path.join(self.directory, sha)
+
+    def __contains__(self, sha):
+        return os.path.exists(self.path(sha))
+
+    def open(self, sha):
+        """
+        Open a cached blob for reading, or return None if it is not cached
+        """
+        try:
+            blob = open(self.path(sha), 'rb')
+        except IOError:
+            return None
+        os.utime(self.path(sha), None)
+        logger.debug('Blob cache hit: {0}'.format(sha))
+        return blob
+
+    def store(self, sha, content):
+        """
+        Copy a file-like object into the cache and return the cached blob opened for reading
+
+        If the cache can't be written to, content is returned rewound so the caller can carry on.
+        """
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Write to a temp file first so readers never see a partial blob
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as temp_file:
+                shutil.copyfileobj(content, temp_file)
+            os.rename(temp_path, self.path(sha))
+        except (IOError, OSError) as e:
+            logger.warning('Could not write blob {0} to the cache: {1}'.format(sha, e))
+            content.seek(0)
+            return content
+        content.close()
+        self.evict(keep=sha)
+        return self.open(sha)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used blobs until the cache fits within max_size
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.tmp-') or name == keep:
+                continue
+            try:
+                stat = os.stat(self.path(name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total_size = sum(size for mtime, size, name in entries)
+        if keep in self:
+            total_size += os.path.getsize(self.path(keep))
+        for mtime, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(self.path(name))
+            except OSError:
+                continue
+            total_size -= size
+            logger.debug('Evicted blob from cache: {0}'.format(name))
@@ -1,3 +1,4 @@
+import codecs
 import json
 
 import validictory
@@ -39,18 +40,167 @@ class GeoJSONParser:
             raise GeoJSONParserException('GeoJSON object must have member named "features" as an array of Features.')
 
         for feature in test_geojson['features']:
-            if not ('type' in feature and feature['type'] == 'Feature' and 'properties' in feature and 'geometry' in feature):
-                raise GeoJSONParserException('GeoJSON Features must have a type of "Feature" and "properties" and "geometry" members.')
-            if feature['geometry'] is None:
-                # null geometries are valid. Move along.
-                continue
-            if feature['geometry']['type'] not in geojson_types:
-                raise GeoJSONParserException('{0} is not a valid GeoJSON geometry.'.format(feature['geometry']['type']))
-            try:
-                validictory.validate(feature['geometry'], geojson_types[feature['geometry']['type']])
-            except validictory.validator.ValidationError as e:
-                raise GeoJSONParserException('GeoJSON validation error. Message: {0}.'.format(str(e)))
-            filtered_geojson['features'].append(feature)
+            if validate_feature(feature):
+                filtered_geojson['features'].append(feature)
 
         # Everything's good
         self.features = filtered_geojson['features']
+
+
+class GeoJSONStreamParser:
+    """
+    Incrementally parse a FeatureCollection from a file-like object of UTF-8 bytes.
+
+    `features` is a generator yielding one validated feature at a time, so memory
+    use is bounded by the largest single feature rather than the whole file.
+    Errors are raised as GeoJSONParserException while iterating.
+
+    A value still incomplete after max_lookahead characters, or lookahead_factor
+    times the largest value so far if that's more, is treated as malformed rather
+    than reading the rest of the file into memory looking for its end.
+    """
+    whitespace = u' \t\n\r'
+
+    def __init__(self, stream, chunk_size=65536, max_lookahead=64 * 1024 * 1024, lookahead_factor=4):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._max_lookahead = max_lookahead
+        self._lookahead_factor = lookahead_factor
+        self._largest_value = 0
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = u''
+        self._pos = 0
+        self._eof = False
+        self.features = self._iter_features()
+
+    def _read(self, size=None):
+        # Pull another chunk into the buffer, returning False at the end of the stream
+        if self._eof:
+            return False
+        if self._pos:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        chunk = self._stream.read(max(size or 0, self._chunk_size))
+        if not chunk:
+            self._eof = True
+            self._buffer += self._text_decoder.decode(b'', final=True)
+            return False
+        if isinstance(chunk, bytes):
+            chunk = self._text_decoder.decode(chunk)
+        self._buffer += chunk
+        return True
+
+    def _peek(self):
+        # Return the next non-whitespace character without consuming it, or None at the end
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in self.whitespace:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read():
+                return None
+
+    def _next_char(self):
+        char = self._peek()
+        if char is not None:
+            self._pos += 1
+        return char
+
+    def _read_ahead(self):
+        # Read at least as much as we already have so large values are not re-scanned too often
+        pending = len(self._buffer) - self._pos
+        if pending >= max(self._max_lookahead, self._lookahead_factor * self._largest_value):
+            raise GeoJSONParserException('Content was not JSON serializeable. A value is incomplete after {0} characters.'.format(pending))
+        return self._read(pending)
+
+    def _decode_value(self):
+        # Decode one JSON value, reading more until it is complete and followed by a delimiter
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                if not self._read_ahead():
+                    raise GeoJSONParserException('Content was not JSON serializeable.')
+                continue
+            while end < len(self._buffer) and self._buffer[end] in self.whitespace:
+                end += 1
+            if end == len(self._buffer) and self._read_ahead():
+                # A number at the end of the buffer may continue in the next chunk
+                continue
+            self._largest_value = max(self._largest_value, end - self._pos)
+            self._pos = end
+            return value
+
+    def _expect(self, delimiters):
+        char = self._next_char()
+        if char not in delimiters:
+            raise GeoJSONParserException('Content was not JSON serializeable.')
+        return char
+
+    def _iter_features(self):
+        first_char = self._peek()
+        if first_char != u'{':
+            if first_char is not None and first_char in u'["-0123456789tfn':
+                raise GeoJSONParserException('Content was not a JSON object.')
+            raise GeoJSONParserException('Content was not JSON serializeable.')
+        self._pos += 1
+
+        found_type = False
+        found_features = False
+        if self._peek() == u'}':
+            self._pos += 1
+        else:
+            while True:
+                if self._peek() != u'"':
+                    raise GeoJSONParserException('Content was not JSON serializeable.')
+                key = self._decode_value()
+                self._expect(u':')
+                if key == 'features':
+                    if self._peek() != u'[':
+                        raise GeoJSONParserException('GeoJSON object must have member named "features" as an array of Features.')
+                    found_features = True
+                    self._pos += 1
+                    if self._peek() == u']':
+                        self._pos += 1
+                    else:
+                        while True:
+                            feature = self._decode_value()
+                            if validate_feature(feature):
+                                yield feature
+                            if self._expect(u',]') == u']':
+                                break
+                else:
+                    value = self._decode_value()
+                    if key == 'type':
+                        if value != 'FeatureCollection':
+                            raise GeoJSONParserException('GeoJSON object must be of type FeatureCollection. The passed type was {0}.'.format(value))
+                        found_type = True
+                if self._expect(u',}') == u'}':
+                    break
+
+        if not found_type:
+            raise GeoJSONParserException('The "type" member is requried and was not found.')
+        if not found_features:
+            raise GeoJSONParserException('GeoJSON object must have member named "features" as an array of Features.')
+
+
+def validate_feature(feature):
+    """
+    Validate a single GeoJSON Feature, raising GeoJSONParserException if it is invalid.
+
+    Returns False for features with null geometries, which are valid but skipped.
+    """
+    if not (isinstance(feature, dict) and 'type' in feature and feature['type'] == 'Feature' and 'properties' in feature and 'geometry' in feature):
+        raise GeoJSONParserException('GeoJSON Features must have a type of "Feature" and "properties" and "geometry" members.')
+    if feature['geometry'] is None:
+        # null geometries are valid. Move along.
+        return False
+    if feature['geometry']['type'] not in geojson_types:
+        raise GeoJSONParserException('{0} is not a valid GeoJSON geometry.'.format(feature['geometry']['type']))
+    try:
+        validictory.validate(feature['geometry'], geojson_types[feature['geometry']['type']])
+    except validictory.validator.ValidationError as e:
+        raise GeoJSONParserException('GeoJSON validation error. Message: {0}.'.format(str(e)))
+    return True
@@ -1,8 +1,9 @@
+import io
 import logging
 
 from django.test import TestCase
 
-from . import GeoJSONParser, test_features, GeoJSONParserException
+from . import GeoJSONParser, GeoJSONStreamParser, test_features, GeoJSONParserException
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.CRITICAL)
@@ -75,3 +76,85 @@ class GeoJSONTest(TestCase):
             pass
         self.assertTrue(isinstance(e, GeoJSONParserException))
         self.assertEqual(str(e), 'GeoJSON validation error. Message: {0}'.format("Failed to validate field 'coordinates' list schema: Value -80.87088507656375 for list item is not of type array."))
+
+
+class GeoJSONStreamTest(TestCase):
+    def parse(self, content, chunk_size=16):
+        return list(GeoJSONStreamParser(io.BytesIO(content), chunk_size=chunk_size).features)
+
+    def test_good_features(self):
+        features = self.parse(test_features.featurecollection)
+        self.assertEqual(len(features), 7)
+        self.assertEqual(features, GeoJSONParser(test_features.featurecollection).features)
+
+    def test_none_geometries(self):
+        features = self.parse(test_features.featurecollection_with_nones)
+        self.assertEqual(len(features), 5)
+
+    def test_type_after_features(self):
+        content = '{"features": [{"type": "Feature", "properties": {"n": 123456}, "geometry": {"type": "Point", "coordinates": [1, 2]}}], "type": "FeatureCollection"}'
+        features = self.parse(content, chunk_size=1)
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]['properties'], {'n': 123456})
+
+    def test_features_are_yielded_lazily(self):
+        geojson = GeoJSONStreamParser(io.BytesIO(test_features.featurecollection), chunk_size=16)
+        feature = next(geojson.features)
+        self.assertEqual(feature['type'], 'Feature')
+
+    def test_not_an_object(self):
+        try:
+            self.parse(test_features.feature_collection_not_an_object)
+        except Exception as e:
+            pass
+        self.assertTrue(isinstance(e, GeoJSONParserException))
+        self.assertEqual(str(e), 'Content was not a JSON object.')
+
+    def test_truncated(self):
+        try:
+            self.parse('{"type": "FeatureCollection", "features": [{"type": "Feature"')
+        except Exception as e:
+            pass
+        self.assertTrue(isinstance(e, GeoJSONParserException))
+        self.assertEqual(str(e), 'Content was not JSON serializeable.')
+
+    def test_unterminated_value(self):
+        content = '{"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {"name": "' + 'x' * 1000
+        geojson = GeoJSONStreamParser(io.BytesIO(content), chunk_size=16, max_lookahead=256)
+        try:
+            list(geojson.features)
+        except Exception as e:
+            pass
+        self.assertTrue(isinstance(e, GeoJSONParserException))
+        self.assertTrue(str(e).startswith('Content was not JSON serializeable. A value is incomplete'))
+        self.assertTrue(len(geojson._buffer) < 1000)
+
+    def test_lookahead_grows_with_largest_value(self):
+        feature = '{"type": "Feature", "properties": {"name": "%s"}, "geometry": {"type": "Point", "coordinates": [1, 2]}}'
+        content = '{"type": "FeatureCollection", "features": [%s, %s]}' % (feature % ('x' * 100), feature % ('x' * 400))
+        features = list(GeoJSONStreamParser(io.BytesIO(content), chunk_size=16, max_lookahead=256).features)
+        self.assertEqual(len(features), 2)
+
+    def test_not_a_featurecollection(self):
+        try:
+            self.parse(test_features.featurecollection_not_a_featurecollection)
+        except Exception as e:
+            pass
+        self.assertTrue(isinstance(e, GeoJSONParserException))
+        self.assertEqual(str(e), 'GeoJSON object must be of type FeatureCollection. The passed type was BunchaFeatures.')
+
+    def test_no_features_member(self):
+        try:
+            self.parse(test_features.featurecollection_no_features_member)
+        except Exception as e:
+            pass
+        self.assertTrue(isinstance(e, GeoJSONParserException))
+        self.assertEqual(str(e), 'GeoJSON object must have member named "features" as an array of Features.')
+
+    def test_bad_geometry_type(self):
+        try:
+            self.parse(test_features.featurecollection_bad_geometry_type)
+        except Exception as e:
+            pass
+        self.assertTrue(isinstance(e, GeoJSONParserException))
+        self.assertEqual(str(e), 'Rhombus is not a valid GeoJSON geometry.')
@@ -1,23 +1,156 @@
+import hashlib
 import json
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from django.conf import settings
+from django.core.cache import get_cache
 from social_auth.models import UserSocialAuth
 
 
+# One connection pool per worker process, created on first use so it's never shared across a fork
+_session = None
+
+# user id -> (access token, expiry timestamp)
+_access_tokens = {}
+
+
+def get_session():
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.GITHUB_POOL_SIZE)
+        session.mount('https://', adapter)
+        _session = session
+    return _session
+
+
+def get_access_token(user):
+    """
+    A user's GitHub access token, cached for GITHUB_ACCESS_TOKEN_TTL seconds
+    """
+    cached = _access_tokens.get(user.id)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+    social_auth_user = UserSocialAuth.objects.get(user=user, provider='github')
+    access_token = social_auth_user.extra_data['access_token']
+    _access_tokens[user.id] = (access_token, time.time() + settings.GITHUB_ACCESS_TOKEN_TTL)
+    return access_token
+
+
+class GitHubRateLimitExceeded(Exception):
+    """
+    The rate limit budget for a GitHub access token has run out
+    """
+    def __init__(self, reset):
+        self.reset = reset
+        super(GitHubRateLimitExceeded, self).__init__('GitHub rate limit exceeded until {0}'.format(reset))
+
+    @property
+    def countdown(self):
+        # Seconds until the budget is replenished
+        return max(int(self.reset - time.time()), 0) + 1
+
+
 class GitHub(object):
     _base_uri = 'https://api.github.com'
+    _raw_media_type = 'application/vnd.github.v3.raw'
 
     def __init__(self, user):
-        social_auth_user = UserSocialAuth.objects.get(user=user, provider='github')
-        social_extra = social_auth_user.extra_data
-        access_token = social_extra['access_token']
+        access_token = get_access_token(user)
         self._headers = {'Authorization': 'token {0}'.format(access_token)}
+        self._token_key = hashlib.sha1(self._headers['Authorization'].encode('utf-8')).hexdigest()
+        self._session = get_session()
+        self._cache = get_cache('github')
+        self._rate_limit_cache = get_cache('github_rate_limit')
+
+    def _request(self, verb, url, **kwargs):
+        response = getattr(self._session, verb)(url, **kwargs)
+        self._record_rate_limit(response)
+        return response
+
+    def _record_rate_limit(self, response):
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        remaining, reset = int(remaining), int(reset)
+        rate_limit = {'remaining': remaining, 'reset': reset}
+        self._rate_limit_cache.set('github-rate-limit:' + self._token_key, rate_limit, max(reset - int(time.time()), 1))
+        if response.status_code == 403 and remaining == 0:
+            raise GitHubRateLimitExceeded(reset)
+
+    @property
+    def rate_limit(self):
+        """
+        The last seen {'remaining': requests, 'reset': timestamp} for this token, or None if unknown
+        """
+        return self._rate_limit_cache.get('github-rate-limit:' + self._token_key)
+
+    def check_rate_limit(self, reserve=0):
+        """
+        Raise GitHubRateLimitExceeded if no more than reserve requests are left until the reset
+        """
+        rate_limit = self.rate_limit
+        if rate_limit is not None and rate_limit['remaining'] <= reserve and rate_limit['reset'] > time.time():
+            raise GitHubRateLimitExceeded(rate_limit['reset'])
 
     def get(self, method):
-        return requests.get(self._base_uri + method, headers=self._headers)
+        """
+        GET an API method, conditionally if we've seen it before
+
+        Responses with an ETag or Last-Modified header are cached unless they're over
+        GITHUB_CACHE_MAX_ENTRY_SIZE bytes, and a 304 Not Modified is answered with the
+        cached response so callers always see a 200.
+        """
+        url = self._base_uri + method
+        cache_key = 'github:' + hashlib.sha1((self._token_key + ' ' + url).encode('utf-8')).hexdigest()
+        cached = self._cache.get(cache_key)
+        headers = dict(self._headers)
+        if cached is not None:
+            if 'etag' in cached['headers']:
+                headers['If-None-Match'] = cached['headers']['etag']
+            if 'last-modified' in cached['headers']:
+                headers['If-Modified-Since'] = cached['headers']['last-modified']
+        response = self._request('get', url, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            return self._cached_response(cached, response)
+        cacheable = 'etag' in response.headers or 'last-modified' in response.headers
+        if response.status_code == 200 and cacheable and len(response.content) <= settings.GITHUB_CACHE_MAX_ENTRY_SIZE:
+            self._cache.set(cache_key, {
+                'url': response.url,
+                'headers': dict((key.lower(), value) for key, value in response.headers.items()),
+                'encoding': response.encoding,
+                'content': response.content,
+            })
+        return response
+
+    def _cached_response(self, cached, not_modified):
+        response = Response()
+        response.status_code = 200
+        response.url = cached['url']
+        response.encoding = cached['encoding']
+        response.headers = CaseInsensitiveDict(cached['headers'])
+        # Fresh headers like the rate limit ones come from the 304
+        response.headers.update(not_modified.headers)
+        response._content = cached['content']
+        response._content_consumed = True
+        # Response has no request attribute until requests sends one, which test doubles may not
+        response.request = getattr(not_modified, 'request', None)
+        return response
+
+    def get_raw(self, method):
+        """
+        Request the raw contents of a file or blob, streaming the body rather than loading it
+        """
+        headers = dict(self._headers, Accept=self._raw_media_type)
+        return self._request('get', self._base_uri + method, headers=headers, stream=True)
 
     def post(self, method, payload):
-        return requests.post(self._base_uri + method, headers=self._headers, data=json.dumps(payload))
+        return self._request('post', self._base_uri + method, headers=self._headers, data=json.dumps(payload))
 
     def delete(self, method):
-        return requests.delete(self._base_uri + method, headers=self._headers)
+        return self._request('delete', self._base_uri + method, headers=self._headers)
@@ -0,0 +1,35 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Q
+
+from gitspatial.models import Feature
+from gitspatial.utils import feature_fragment
+
+
+class Command(NoArgsCommand):
+    help = 'Fill in the stored GeoJSON and simplified geometries of features synced before they existed'
+
+    def handle_noargs(self, **options):
+        batch_size = settings.FEATURE_SET_BATCH_SIZE
+        missing = Q(feature_json='')
+        for tolerance, field in Feature.simplified_geoms:
+            missing |= Q(**{field + '__isnull': True})
+        last_id = 0
+        backfilled = 0
+        while True:
+            # By id so a row that can't be filled in isn't fetched again
+            features = list(Feature.objects.filter(missing, id__gt=last_id).order_by('id')[:batch_size])
+            if not features:
+                break
+            with transaction.commit_on_success():
+                for feature in features:
+                    updates = dict((field, feature.geom.simplify(tolerance, preserve_topology=True))
+                                   for tolerance, field in Feature.simplified_geoms)
+                    updates['feature_json'] = feature_fragment(json.loads(feature.geom.json), json.loads(feature.properties))
+                    Feature.objects.filter(id=feature.id).update(**updates)
+            last_id = features[-1].id
+            backfilled += len(features)
+            self.stdout.write('Backfilled {0} features'.format(backfilled))
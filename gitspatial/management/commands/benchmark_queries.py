@@ -0,0 +1,56 @@
+from optparse import make_option
+
+from django.contrib.gis.geos.point import Point
+from django.contrib.gis.measure import D
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from gitspatial.api.helpers import query_args
+from gitspatial.models import FeatureSet, Feature
+
+
+class Command(BaseCommand):
+    args = '<feature_set_id>'
+    help = 'Run the query API\'s searches on a feature set and print their PostgreSQL query plans'
+    option_list = BaseCommand.option_list + (
+        make_option('--distance', type='float', default=1000,
+                    help='Meters around the feature set\'s center for distance searches, 1000 by default'),
+        make_option('--nearest', type='int', default=10,
+                    help='How many features nearest searches find, 10 by default'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: benchmark_queries {0}'.format(self.args))
+        try:
+            feature_set = FeatureSet.objects.get(id=args[0])
+        except (FeatureSet.DoesNotExist, ValueError):
+            raise CommandError('There is no feature set {0}'.format(args[0]))
+        if feature_set.bounds is None:
+            raise CommandError('Feature set {0} has no features'.format(feature_set))
+
+        lon, lat = feature_set.center
+        xmin, ymin, xmax, ymax = feature_set.bounds
+        # The middle quarter of the feature set
+        bbox = '{0},{1},{2},{3}'.format((xmin + lon) / 2, (ymin + lat) / 2, (xmax + lon) / 2, (ymax + lat) / 2)
+        distance = options['distance']
+        live = Feature.objects.live(feature_set)
+        nearest_args = query_args.by_nearest(lat, lon, options['nearest'])
+
+        searches = (
+            ('bbox={0}'.format(bbox), live.filter(**query_args.by_bbox(bbox))),
+            ('distance={0} without a bbox prefilter'.format(distance),
+             live.filter(geom__distance_lte=(Point(x=lon, y=lat, srid=4326), D(m=distance)))),
+            ('distance={0}'.format(distance), live.filter(**query_args.by_lat_lon_distance(lat, lon, distance))),
+            ('nearest={0}'.format(options['nearest']),
+             query_args.nearest_features(live, nearest_args, options['nearest']).extra(**nearest_args)[:options['nearest']]),
+        )
+
+        cursor = connection.cursor()
+        for name, queryset in searches:
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute('EXPLAIN ANALYZE ' + sql, params)
+            self.stdout.write('{0} ({1})'.format(name, feature_set))
+            for row in cursor.fetchall():
+                self.stdout.write('    ' + row[0])
+            self.stdout.write('')
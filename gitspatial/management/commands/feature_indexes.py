@@ -0,0 +1,17 @@
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.core.management.sql import custom_sql_for_model
+from django.db import connection, transaction
+
+from gitspatial.models import Feature
+
+
+class Command(NoArgsCommand):
+    help = 'Create the Feature indexes from gitspatial/sql/feature.sql on an existing database'
+
+    def handle_noargs(self, **options):
+        cursor = connection.cursor()
+        for statement in custom_sql_for_model(Feature, no_style(), connection):
+            self.stdout.write(statement)
+            cursor.execute(statement)
+        transaction.commit_unless_managed()
@@ -0,0 +1,31 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gitspatial.models import FeatureSet
+from gitspatial.tasks import schedule_feature_set_sync, USER_SYNC_QUEUE
+
+
+class Command(BaseCommand):
+    args = '<feature_set_id feature_set_id ...>'
+    help = 'Queue syncs of feature sets from GitHub'
+    option_list = BaseCommand.option_list + (
+        make_option('--force', action='store_true', default=False,
+                    help='Reingest the feature sets even if their files haven\'t changed, from the blob cache when possible'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Usage: sync_feature_sets {0}'.format(self.args))
+        for feature_set_id in args:
+            try:
+                feature_set = FeatureSet.objects.get(id=feature_set_id)
+            except (FeatureSet.DoesNotExist, ValueError):
+                raise CommandError('There is no feature set {0}'.format(feature_set_id))
+            if not feature_set.synced:
+                self.stderr.write('Feature set {0} is not synced, skipping it'.format(feature_set))
+                continue
+            if schedule_feature_set_sync(feature_set, force=options['force'], countdown=0, queue=USER_SYNC_QUEUE):
+                self.stdout.write('Queued a sync of feature set {0}'.format(feature_set))
+            else:
+                self.stdout.write('A sync of feature set {0} is already pending'.format(feature_set))
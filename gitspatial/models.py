@@ -1,4 +1,6 @@
+import psycopg2.extensions
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.models import User
 from django.contrib.gis.db import models as geo_models
 
@@ -32,6 +34,11 @@ class FeatureSet(Syncable, Timestampable, models.Model):
     name = models.CharField(max_length=1000)  # The editable name of the feature set, initially the same as path
     size = models.IntegerField()  # Size in bytes, just trusting GitHub API here
     synced = models.BooleanField(default=False)  # Just like Repo, not all are synced
+    blob_sha = models.CharField(max_length=40, blank=True)  # The git blob SHA of the file as last ingested
+    generation = models.IntegerField(default=0)  # The generation of features readers see, bumped when a sync finishes
+    sync_pending_since = models.DateTimeField(null=True, blank=True)  # When a queued sync that hasn't started yet was requested
+    pending_blob_sha = models.CharField(max_length=40, blank=True)  # The blob SHA the pending sync was requested with, blank to look it up
+    feature_count = models.IntegerField(null=True, blank=True)  # How many features the current generation has, stored when a sync finishes
 
     unique_together = ('repo', 'name')
 
@@ -41,7 +48,7 @@ class FeatureSet(Syncable, Timestampable, models.Model):
         if hasattr(self, '_bounds'):
             return self._bounds
         else:
-            bounds = Feature.objects.filter(feature_set=self).extent()
+            bounds = Feature.objects.live(self).extent()
             self._bounds = bounds
         return self._bounds
 
@@ -61,16 +68,56 @@ class FeatureSet(Syncable, Timestampable, models.Model):
         return '{0}/{1}'.format(self.repo.full_name, self.name)
 
 
+class FeatureManager(geo_models.GeoManager):
+    def live(self, feature_set):
+        """
+        The features in a feature set's current generation, the only ones readers should see
+        """
+        generation = feature_set.generation
+        return self.filter(feature_set=feature_set, generation__lte=generation).filter(
+            Q(retired_generation__isnull=True) | Q(retired_generation__gt=generation))
+
+
+class JSONBField(models.TextField):
+    """
+    Serialized JSON kept in a PostgreSQL jsonb column, read and written as a string like a TextField
+    """
+    def db_type(self, connection):
+        return 'jsonb'
+
+
+# psycopg2 2.5.4 and later decode jsonb into Python objects, keep reading it as a string instead
+JSONB_OID, JSONB_ARRAY_OID = 3802, 3807
+JSONB = psycopg2.extensions.new_type((JSONB_OID,), 'JSONB', lambda value, cursor: value)
+psycopg2.extensions.register_type(JSONB)
+psycopg2.extensions.register_type(psycopg2.extensions.new_array_type((JSONB_ARRAY_OID,), 'JSONB[]', JSONB))
+
+
 class Feature(geo_models.Model):
     """
     Represents a single feature belonging to a FeatureSet, a GeoJSON Feature
+
+    A feature is visible from the FeatureSet generation it was created in until the
+    one it was retired in, so a sync can write the next generation alongside the
+    current one and readers switch over when FeatureSet.generation is bumped.
     """
     feature_set = models.ForeignKey(FeatureSet)
-    geom = geo_models.GeometryField()
-    properties = models.TextField()
-    objects = geo_models.GeoManager()
+    geom = geo_models.GeometryField()  # Also indexed together with feature_set, see sql/feature.sql
+    # Copies of geom simplified at sync time, see simplified_geoms. They're never searched so they aren't indexed.
+    geom_10m = geo_models.GeometryField(null=True, blank=True, spatial_index=False)
+    geom_100m = geo_models.GeometryField(null=True, blank=True, spatial_index=False)
+    geom_1km = geo_models.GeometryField(null=True, blank=True, spatial_index=False)
+    properties = JSONBField()  # Indexed for containment queries, see sql/feature.sql
+    feature_json = models.TextField(blank=True)  # The serialized GeoJSON Feature minus its id, see utils.feature_fragment
+    content_hash = models.CharField(max_length=40, blank=True)  # SHA-1 of the geometry and properties, see utils.feature_hash
+    generation = models.IntegerField(default=0)  # The first generation this feature is part of
+    retired_generation = models.IntegerField(null=True, blank=True)  # The first generation this feature is no longer part of
+    objects = FeatureManager()
 
     ordering = ['id']
 
+    # (tolerance in degrees, field) for each simplified copy of geom, coarsest first
+    simplified_geoms = ((0.01, 'geom_1km'), (0.001, 'geom_100m'), (0.0001, 'geom_10m'))
+
     def __unicode__(self):
         return '<Feature {0} from {1}>'.format(self.id, self.feature_set)
@@ -0,0 +1,10 @@
+-- Run by syncdb after creating the gitspatial_feature table, and by the feature_indexes command on existing databases
+
+-- GiST operator classes for plain columns like feature_set_id
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+
+-- Every spatial query is within one feature set, so the index narrows by both at once
+CREATE INDEX IF NOT EXISTS gitspatial_feature_feature_set_id_geom_gist ON gitspatial_feature USING GIST (feature_set_id, geom);
+
+-- Property filters are jsonb containment queries, jsonb_path_ops makes for a smaller index that only answers @>
+CREATE INDEX IF NOT EXISTS gitspatial_feature_properties_gin ON gitspatial_feature USING GIN (properties jsonb_path_ops);
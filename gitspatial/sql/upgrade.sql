@@ -0,0 +1,33 @@
+-- Brings a database created by syncdb before the columns below existed up to date with gitspatial/models.py.
+-- Not run by syncdb, it's only for existing databases, see "Upgrading an Existing Database" in README.md.
+-- Every statement can be rerun. Afterwards run, in order:
+--   python manage.py feature_indexes
+--   python manage.py backfill_features
+--   python manage.py createcachetable gitspatial_github_rate_limit
+
+BEGIN;
+
+-- Property filters are jsonb containment queries
+ALTER TABLE gitspatial_feature ALTER COLUMN properties TYPE jsonb USING properties::jsonb;
+
+-- Feature set sync state
+ALTER TABLE gitspatial_featureset ADD COLUMN IF NOT EXISTS blob_sha varchar(40) NOT NULL DEFAULT '';
+ALTER TABLE gitspatial_featureset ADD COLUMN IF NOT EXISTS generation integer NOT NULL DEFAULT 0;
+ALTER TABLE gitspatial_featureset ADD COLUMN IF NOT EXISTS sync_pending_since timestamp with time zone NULL;
+ALTER TABLE gitspatial_featureset ADD COLUMN IF NOT EXISTS pending_blob_sha varchar(40) NOT NULL DEFAULT '';
+ALTER TABLE gitspatial_featureset ADD COLUMN IF NOT EXISTS feature_count integer NULL;
+
+-- Existing features are all part of generation 0, the one existing feature sets start at
+ALTER TABLE gitspatial_feature ADD COLUMN IF NOT EXISTS generation integer NOT NULL DEFAULT 0;
+ALTER TABLE gitspatial_feature ADD COLUMN IF NOT EXISTS retired_generation integer NULL;
+
+-- Left blank here, the next sync of a feature set replaces features without a hash
+ALTER TABLE gitspatial_feature ADD COLUMN IF NOT EXISTS content_hash varchar(40) NOT NULL DEFAULT '';
+
+-- Filled in by backfill_features
+ALTER TABLE gitspatial_feature ADD COLUMN IF NOT EXISTS feature_json text NOT NULL DEFAULT '';
+ALTER TABLE gitspatial_feature ADD COLUMN IF NOT EXISTS geom_10m geometry(Geometry, 4326) NULL;
+ALTER TABLE gitspatial_feature ADD COLUMN IF NOT EXISTS geom_100m geometry(Geometry, 4326) NULL;
+ALTER TABLE gitspatial_feature ADD COLUMN IF NOT EXISTS geom_1km geometry(Geometry, 4326) NULL;
+
+COMMIT;
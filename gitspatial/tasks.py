@@ -1,33 +1,59 @@
-import base64
+import datetime
 import json
 import logging
+import posixpath
+import tempfile
+import time
+import urllib
+from contextlib import contextmanager
 
 from celery import task
+from celery.exceptions import RetryTaskError
+from django.conf import settings
+from django.contrib.auth.models import User
 from django.contrib.gis.geos import GEOSGeometry
 from django.contrib.gis.geos.error import GEOSException
+from django.db import connection, transaction
+from django.db.models import Q
 from django.db.models.query import QuerySet
+from django.utils import timezone
 
+from .blob_cache import BlobCache
 from .models import Repo, FeatureSet, Feature
-from .github import GitHub
-from .geojson import GeoJSONParser, GeoJSONParserException
-from .utils import strip_zs
+from .github import GitHub, GitHubRateLimitExceeded
+from .geojson import GeoJSONStreamParser, GeoJSONParserException
+from .utils import feature_fragment, feature_hash, strip_zs
 
 
 logger = logging.getLogger(__name__)
 
+# First key of the PostgreSQL advisory locks held while syncing a feature set, the second is its id
+FEATURE_SET_LOCK_NAMESPACE = 1
 
-@task(name='get_user_repos')
-def get_user_repos(user):
+# Celery queues for syncs somebody is waiting on and for syncs triggered by GitHub web hooks
+USER_SYNC_QUEUE = 'sync_user'
+HOOK_SYNC_QUEUE = 'sync_hook'
+
+
+@task(name='get_user_repos', max_retries=None)
+def get_user_repos(user_id):
     """
     Create or update the repos for a user
+
+    Starts over once the GitHub rate limit resets if it runs out part way through.
     """
+    user = User.objects.get(id=user_id)
     previous_repos = Repo.objects.filter(user=user)
     github = GitHub(user)
     current_repos = []
     api_path = '/user/repos'
     there_are_more_repos = True
     while there_are_more_repos:
-        gh_request = github.get(api_path)
+        try:
+            gh_request = github.get(api_path)
+        except GitHubRateLimitExceeded as e:
+            logger.warning('Deferring repos for user {0} for {1}s: {2}'.format(user, e.countdown, e))
+            raise get_user_repos.retry(exc=e, countdown=e.countdown)
         if hasattr(gh_request, 'links') and 'next' in gh_request.links:
             next_url = gh_request.links['next']['url']
             next_url_parts = next_url.split('api.github.com')
@@ -60,25 +86,40 @@ def get_user_repos(user):
             previous_repo.delete()
 
 
-@task(name='get_repo_feature_sets')
-def get_repo_feature_sets(repo, sync_feature_sets=True):
+@task(name='get_repo_feature_sets', max_retries=None)
+def get_repo_feature_sets(repo_id, sync_feature_sets=True, queue=HOOK_SYNC_QUEUE):
     """
-    Create or update the feature sets for a repo
+    Create or update the feature sets for a repo, queueing feature set syncs on queue
+
+    Waits for the GitHub rate limit to reset if the token is down to its reserve.
     """
+    try:
+        repo = Repo.objects.get(id=repo_id)
+    except Repo.DoesNotExist:
+        return
     previous_feature_sets = FeatureSet.objects.filter(repo=repo)
     github = GitHub(repo.user)
     current_feature_sets = []
-    gh_request = github.get('/repos/{0}/git/trees/master?recursive=1'.format(repo.full_name))
+    try:
+        github.check_rate_limit(settings.GITHUB_RATE_LIMIT_RESERVE)
+        gh_request = github.get('/repos/{0}/git/trees/master?recursive=1'.format(repo.full_name))
+    except GitHubRateLimitExceeded as e:
+        logger.warning('Deferring feature sets for repo {0} for {1}s: {2}'.format(repo, e.countdown, e))
+        raise get_repo_feature_sets.retry(exc=e, countdown=e.countdown)
     for item in gh_request.json()['tree']:
         if item['type'] == 'blob' and item['path'].endswith('.geojson'):
             defaults = {'name': item['path'], 'size': item['size']}
             feature_set, created = FeatureSet.objects.get_or_create(repo=repo, path=item['path'], defaults=defaults)
             current_feature_sets.append(feature_set)
             if feature_set.synced and sync_feature_sets:
+                if feature_set.blob_sha == item['sha'] and feature_set.sync_status == FeatureSet.SYNCED:
+                    logger.info('Feature set is unchanged, not syncing: {0}'.format(feature_set))
+                    continue
                 logger.info('Setting feature set sync status as syncing: {0}'.format(feature_set))
                 feature_set.sync_status = FeatureSet.SYNCING
-                feature_set.save()
-                get_feature_set_features.apply_async((feature_set,))
+                feature_set.save(update_fields=['sync_status', 'updated_date'])
+                # The sync can use the blob SHA from this tree rather than looking it up again
+                schedule_feature_set_sync(feature_set, blob_sha=item['sha'], queue=queue)
     for previous_feature_set in previous_feature_sets:
         if previous_feature_set not in current_feature_sets:
             previous_feature_set.delete()
@@ -87,44 +128,196 @@ def get_repo_feature_sets(repo, sync_feature_sets=True):
     repo.save()
 
 
-@task(name='get_feature_set_features')
-def get_feature_set_features(feature_set):
+@task(name='get_feature_set_features', max_retries=None)
+def get_feature_set_features(feature_set_id, force=False):
+    """
+    Sync the features for a feature set from its GeoJSON file on GitHub
+
+    The git blob SHA of the file is the one the pending sync was requested with, if
+    any, or else looked up. Unless force is set, syncing is skipped when the SHA
+    matches the last ingested one. A forced sync reparses the cached blob without
+    going to GitHub at all. Waits for the GitHub rate limit to reset if the token is
+    down to its reserve.
+
+    Only one sync of a feature set runs at a time. If another is running, this one
+    stays pending and retries after FEATURE_SET_SYNC_DEBOUNCE seconds.
+    """
+    with _feature_set_lock(feature_set_id) as locked:
+        if not locked:
+            logger.info('Feature set is already syncing, retrying later: {0}'.format(feature_set_id))
+            raise get_feature_set_features.retry(countdown=settings.FEATURE_SET_SYNC_DEBOUNCE)
+        try:
+            feature_set, blob_sha = _start_pending_sync(feature_set_id)
+        except FeatureSet.DoesNotExist:
+            return
+        _sync_feature_set(feature_set, blob_sha, force)
+
+
+def _start_pending_sync(feature_set_id):
+    """
+    Take over a feature set's pending sync, returning the feature set and the blob SHA it was requested with or None
+
+    The row is locked while it's read and cleared so a request collapsing into the
+    pending sync can't slip in between and be forgotten.
+    """
+    with transaction.commit_on_success():
+        # Read it now we hold the lock, a sync that just finished may have moved the generation on
+        feature_set = FeatureSet.objects.select_for_update().get(id=feature_set_id)
+        # This run covers every sync requested while it was pending
+        FeatureSet.objects.filter(id=feature_set_id).update(sync_pending_since=None, pending_blob_sha='')
+    return feature_set, feature_set.pending_blob_sha or None
+
+
+def _sync_feature_set(feature_set, blob_sha, force):
     """
-    Delete all features for, and create features for a feature set
+    Sync a feature set, leaving it marked as errored rather than syncing if the sync blows up
     """
-    one_megabyte = 1048576
-    # First, kill the current features
+    try:
+        _sync_feature_set_blob(feature_set, blob_sha, force)
+    except RetryTaskError:
+        raise
+    except Exception as e:
+        logger.exception('Error syncing FeatureSet: {0}'.format(feature_set))
+        # A failed query leaves the transaction aborted until it's rolled back
+        transaction.rollback_unless_managed()
+        # The generation is only bumped in memory if saving it was what failed
+        feature_set.generation = FeatureSet.objects.get(id=feature_set.id).generation
+        _discard_unfinished_generations(feature_set)
+        logger.info('Setting feature set sync status as error syncing: {0}'.format(feature_set))
+        feature_set.sync_status = FeatureSet.MEMORY_ERROR if isinstance(e, MemoryError) else FeatureSet.ERROR_SYNCING
+        feature_set.save(update_fields=['sync_status', 'updated_date'])
+        raise
+
+
+def _sync_feature_set_blob(feature_set, blob_sha, force):
     if not feature_set.synced:
         return
     logger.info('Setting feature set sync status as syncing: {0}'.format(feature_set))
     feature_set.sync_status = feature_set.SYNCING
-    feature_set.save()
-    Feature.objects.filter(feature_set=feature_set).delete()
-    github = GitHub(feature_set.repo.user)
-    if feature_set.size < one_megabyte:
-        # We can get files < 1 megabyte via the Repo API
-        gh_request = github.get('/repos/{0}/contents/{1}'.format(feature_set.repo.full_name, feature_set.path))
-        content = base64.b64decode(gh_request.json()['content'])
-    else:
-        # For files > 1 megabyte, we have to a lot of HTTP dancing
-        try:
-            content = _get_blob(github, feature_set)
-        except MemoryError:
-            logger.error('MemoryError parsing FeatureSet: {0}'.format(feature_set))
-            logger.info('Setting feature set sync status as error syncing: {0}'.format(feature_set))
-            feature_set.sync_status = FeatureSet.MEMORY_ERROR
-            feature_set.save()
+    feature_set.save(update_fields=['sync_status', 'updated_date'])
+    blob_cache = BlobCache()
+    try:
+        if blob_sha is None:
+            if force and feature_set.blob_sha and feature_set.blob_sha in blob_cache:
+                blob_sha = feature_set.blob_sha
+            else:
+                blob_sha = _get_blob_sha(_rate_limited_github(feature_set), feature_set)
+                if blob_sha is None:
+                    logger.info('Setting feature set sync status as error syncing: {0}'.format(feature_set))
+                    feature_set.sync_status = FeatureSet.ERROR_SYNCING
+                    feature_set.save(update_fields=['sync_status', 'updated_date'])
+                    return
+        if blob_sha == feature_set.blob_sha and not force:
+            logger.info('Feature set is unchanged, setting sync status as synced: {0}'.format(feature_set))
+            feature_set.sync_status = FeatureSet.SYNCED
+            feature_set.save(update_fields=['sync_status', 'updated_date'])
+            return
+        content = blob_cache.open(blob_sha)
+        if content is None:
+            content = _download(_rate_limited_github(feature_set), '/repos/{0}/git/blobs/{1}'.format(feature_set.repo.full_name, blob_sha))
+            if content is None:
+                logger.info('Setting feature set sync status as error syncing: {0}'.format(feature_set))
+                feature_set.sync_status = FeatureSet.ERROR_SYNCING
+                feature_set.save(update_fields=['sync_status', 'updated_date'])
+                return
+            content = blob_cache.store(blob_sha, content)
+    except GitHubRateLimitExceeded as e:
+        if not _claim_pending_sync(feature_set, blob_sha):
+            # A sync requested since this one started is queued and will do instead
+            logger.info('Leaving feature set {0} to the sync requested since: {1}'.format(feature_set, e))
             return
+        # Pending again, so syncs requested meanwhile collapse into the retry
+        logger.warning('Deferring sync of feature set {0} for {1}s: {2}'.format(feature_set, e.countdown, e))
+        raise get_feature_set_features.retry(exc=e, countdown=e.countdown)
+    geojson = GeoJSONStreamParser(content)
+    start_time = time.time()
+    # Clear out anything an earlier failed sync left behind, then write the next generation
+    _discard_unfinished_generations(feature_set)
     try:
-        geojson = GeoJSONParser(content)
+        counts = _sync_features(feature_set, geojson.features, feature_set.generation + 1)
     except GeoJSONParserException as e:
         logger.error('GeoJSONParserError parsing FeatureSet: {0} with error: {1}'.format(feature_set, e))
+        _discard_unfinished_generations(feature_set)
         logger.info('Setting feature set sync status as error syncing: {0}'.format(feature_set))
         feature_set.sync_status = FeatureSet.ERROR_SYNCING
-        feature_set.save()
+        feature_set.save(update_fields=['sync_status', 'updated_date'])
         return
-    for feature in geojson.features:
+    finally:
+        content.close()
+    elapsed = time.time() - start_time
+    rows_per_second = counts['total'] / elapsed if elapsed else counts['total']
+    logger.info('Synced {0} features for {1} in {2:.2f}s ({3:.0f} rows/s): {4} created, {5} deleted, {6} unchanged'.format(
+        counts['total'], feature_set, elapsed, rows_per_second, counts['created'], counts['deleted'], counts['unchanged']))
+    logger.info('Setting feature set sync status as synced: {0}'.format(feature_set))
+    # Readers switch to the new generation with this single UPDATE
+    feature_set.generation += 1
+    feature_set.sync_status = FeatureSet.SYNCED
+    feature_set.blob_sha = blob_sha
+    feature_set.feature_count = counts['created'] + counts['unchanged']
+    feature_set.save(update_fields=['generation', 'sync_status', 'blob_sha', 'feature_count', 'updated_date'])
+    delete_retired_features.apply_async((feature_set.id,), countdown=settings.FEATURE_SET_RETIRED_GRACE_PERIOD)
+
+
+@task(name='delete_repo_feature_sets')
+def delete_repo_feature_sets(repo_id):
+    logger.info('Deleting feature sets for repo: {0}'.format(repo_id))
+    FeatureSet.objects.filter(repo_id=repo_id).delete()
+
+
+@task(name='delete_feature_set_features')
+def delete_feature_set_features(feature_set_id):
+    logger.info('Deleting features for feature set: {0}'.format(feature_set_id))
+    Feature.objects.filter(feature_set_id=feature_set_id).delete()
+    # Forget what was ingested so the next sync doesn't short-circuit
+    FeatureSet.objects.filter(id=feature_set_id).update(blob_sha='', feature_count=None)
+
+
+@task(name='delete_retired_features')
+def delete_retired_features(feature_set_id):
+    """
+    Delete features that are no longer part of a feature set's current generation
+    """
+    try:
+        generation = FeatureSet.objects.get(id=feature_set_id).generation
+    except FeatureSet.DoesNotExist:
+        return
+    logger.info('Deleting retired features for feature set: {0}'.format(feature_set_id))
+    Feature.objects.filter(feature_set_id=feature_set_id, retired_generation__lte=generation).delete()
+
+
+def _discard_unfinished_generations(feature_set):
+    """
+    Undo the writes of a sync that never made it to bumping the feature set's generation
+    """
+    Feature.objects.filter(feature_set=feature_set, generation__gt=feature_set.generation).delete()
+    Feature.objects.filter(feature_set=feature_set, retired_generation__gt=feature_set.generation).update(retired_generation=None)
+
+
+def _sync_features(feature_set, features, generation):
+    """
+    Write the difference between a feature set's live features and incoming GeoJSON features as a new generation
+
+    Each feature is identified by a hash of its geometry and properties. Features whose
+    hash is already live are carried over untouched, new or changed ones are inserted into
+    the new generation in batches of FEATURE_SET_BATCH_SIZE and live features that are no
+    longer present are retired from it. Nothing is visible to readers until the feature set's
+    generation is bumped. Returns a dict of total, created, deleted and unchanged counts.
+    """
+    batch_size = settings.FEATURE_SET_BATCH_SIZE
+    stored = {}
+    for feature_id, content_hash in Feature.objects.live(feature_set).values_list('id', 'content_hash'):
+        stored.setdefault(content_hash, []).append(feature_id)
+    counts = {'total': 0, 'created': 0, 'deleted': 0, 'unchanged': 0}
+    batch = []
+    for feature in features:
+        counts['total'] += 1
         geojson_geometry = strip_zs(feature['geometry'])
+        content_hash = feature_hash(geojson_geometry, feature['properties'])
+        if stored.get(content_hash):
+            # Unchanged, keep the stored row
+            stored[content_hash].pop()
+            counts['unchanged'] += 1
+            continue
         try:
             geom = GEOSGeometry(json.dumps(geojson_geometry))
         except GEOSException:
@@ -132,46 +325,124 @@ def get_feature_set_features(feature_set):
             # This one feature failed, but let's process the rest.
             continue
         properties = json.dumps(feature['properties'])
-        feature = Feature(feature_set=feature_set, geom=geom, properties=properties)
-        feature.save()
-        logger.debug('Created Feature: {0}'.format(feature))
-    logger.info('Setting feature set sync status as synced: {0}'.format(feature_set))
-    feature_set.sync_status = FeatureSet.SYNCED
-    feature_set.save()
+        feature_json = feature_fragment(geojson_geometry, feature['properties'])
+        simplified_geoms = dict((field, geom.simplify(tolerance, preserve_topology=True)) for tolerance, field in Feature.simplified_geoms)
+        batch.append(Feature(feature_set=feature_set, geom=geom, properties=properties, feature_json=feature_json,
+                             content_hash=content_hash, generation=generation, **simplified_geoms))
+        if len(batch) >= batch_size:
+            Feature.objects.bulk_create(batch)
+            counts['created'] += len(batch)
+            logger.debug('Created {0} features for {1}'.format(counts['created'], feature_set))
+            batch = []
+    if batch:
+        Feature.objects.bulk_create(batch)
+        counts['created'] += len(batch)
+    removed_ids = [feature_id for feature_ids in stored.values() for feature_id in feature_ids]
+    for i in range(0, len(removed_ids), batch_size):
+        Feature.objects.filter(id__in=removed_ids[i:i + batch_size]).update(retired_generation=generation)
+    counts['deleted'] = len(removed_ids)
+    return counts
 
 
-@task(name='delete_repo_feature_sets')
-def delete_repo_feature_sets(repo):
-    logger.info('Deleting feature sets for repo: {0}'.format(repo))
-    FeatureSet.objects.filter(repo=repo).delete()
+def schedule_feature_set_sync(feature_set, blob_sha=None, force=False, countdown=None, queue=HOOK_SYNC_QUEUE):
+    """
+    Queue a sync of a feature set on queue unless one is already pending
 
+    Syncs requested while one is pending collapse into it. The queued sync waits
+    FEATURE_SET_SYNC_DEBOUNCE seconds by default so a burst of pushes is picked up
+    by a single sync, which looks up the latest blob SHA when it runs unless
+    blob_sha is given. The latest request decides, so one without a blob_sha
+    collapsing into a pending sync makes it look the SHA up after all.
+    Returns True if a sync was queued.
+    """
+    if not _claim_pending_sync(feature_set, blob_sha):
+        collapsed = FeatureSet.objects.filter(id=feature_set.id, sync_pending_since__isnull=False).update(
+            pending_blob_sha=blob_sha or '')
+        # If not, the pending sync started in the meantime, so claim a new one
+        if collapsed or not _claim_pending_sync(feature_set, blob_sha):
+            logger.info('Sync already pending for feature set: {0}'.format(feature_set))
+            return False
+    if countdown is None:
+        countdown = settings.FEATURE_SET_SYNC_DEBOUNCE
+    get_feature_set_features.apply_async((feature_set.id,), {'force': force}, countdown=countdown, queue=queue)
+    return True
 
-@task(name='delete_feature_set_features')
-def delete_feature_set_features(feature_set):
-    logger.info('Deleting features for feature set: {0}'.format(feature_set))
-    Feature.objects.filter(feature_set=feature_set).delete()
 
+def _claim_pending_sync(feature_set, blob_sha=None):
+    """
+    Mark a feature set as having a sync pending for blob_sha, returning False if one already was
 
-def _get_blob(github, feature_set):
-    # Get the head of the master branch
-    head_request = github.get('/repos/{0}/git/refs/heads/{1}'.format(feature_set.repo.full_name, feature_set.repo.master_branch))
+    Pending marks older than FEATURE_SET_SYNC_PENDING_TIMEOUT are treated as lost.
+    """
+    now = timezone.now()
+    stale = now - datetime.timedelta(seconds=settings.FEATURE_SET_SYNC_PENDING_TIMEOUT)
+    claimed = FeatureSet.objects.filter(id=feature_set.id).filter(
+        Q(sync_pending_since__isnull=True) | Q(sync_pending_since__lt=stale)).update(
+        sync_pending_since=now, pending_blob_sha=blob_sha or '')
+    return claimed == 1
 
-    # Get the latest commit  in this branch
-    commit_request = github.get(head_request.json()['object']['url'].split('github.com')[1])
 
-    # Get the tree from the latest commit
-    tree_request = github.get(commit_request.json()['tree']['url'].split('github.com')[1] + '?recursive=1')
-    blob_url = None
-    for item in tree_request.json()['tree']:
-        if item['path'] == feature_set.path:
-            blob_url = item['url'].split('github.com')[1]
-            continue
+@contextmanager
+def _feature_set_lock(feature_set_id):
+    """
+    Hold a PostgreSQL advisory lock on a feature set, yielding whether it was acquired
 
-    # Get the blob
+    The lock belongs to the database session, so it's shared across workers and goes
+    away by itself if the worker dies.
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', [FEATURE_SET_LOCK_NAMESPACE, feature_set_id])
+    locked = cursor.fetchone()[0]
     try:
-        blob_request = github.get(blob_url)
-        encoded_content = blob_request.json()['content']
-        decoded = base64.b64decode(encoded_content)
-    except MemoryError:
-        raise
-    return decoded
+        yield locked
+    finally:
+        if locked:
+            cursor = connection.cursor()
+            cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [FEATURE_SET_LOCK_NAMESPACE, feature_set_id])
+
+
+def _rate_limited_github(feature_set):
+    """
+    A GitHub client for a feature set's owner, raising GitHubRateLimitExceeded if its budget is down to the reserve
+    """
+    github = GitHub(feature_set.repo.user)
+    github.check_rate_limit(settings.GITHUB_RATE_LIMIT_RESERVE)
+    return github
+
+
+def _get_blob_sha(github, feature_set):
+    """
+    Find the git blob SHA of a feature set's file at the head of the repo's master branch
+
+    The contents of the file's directory list each file's SHA without its content, which
+    is much less to fetch for a big repo than its whole tree.
+    """
+    directory = posixpath.dirname(feature_set.path)
+    contents_request = github.get('/repos/{0}/contents/{1}?ref={2}'.format(
+        feature_set.repo.full_name, urllib.quote(directory.encode('utf-8')), urllib.quote(feature_set.repo.master_branch.encode('utf-8'))))
+    contents = contents_request.json() if contents_request.status_code == 200 else []
+    # A list for a directory, anything else means it isn't one any more
+    for item in contents if isinstance(contents, list) else []:
+        if item['path'] == feature_set.path and item['type'] == 'file':
+            return item['sha']
+    logger.error('Could not find {0} in {1}'.format(feature_set.path, feature_set.repo))
+    return None
+
+
+def _download(github, api_path):
+    """
+    Stream the raw contents of a file or blob into a spooled temp file, returning it rewound
+
+    Returns None if GitHub did not respond with the file.
+    """
+    response = github.get_raw(api_path)
+    if response.status_code != 200:
+        logger.error('Could not download {0}, GitHub responded with {1}'.format(api_path, response.status_code))
+        # Read the error body so the connection goes back to the pool
+        response.content
+        return None
+    content = tempfile.SpooledTemporaryFile(max_size=settings.BLOB_SPOOL_MAX_SIZE)
+    for chunk in response.iter_content(chunk_size=65536):
+        content.write(chunk)
+    content.seek(0)
+    return content
@@ -1,12 +1,28 @@
+import datetime
+import io
+import json
 import logging
+import os
+import shutil
+import tempfile
+import time
 
 from django.contrib.auth.models import User
+from django.core.cache import get_cache
+from django.core.management import call_command
 from django.test import TestCase
 from django.test.client import Client, RequestFactory
-
+from django.utils import timezone
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from social_auth.models import UserSocialAuth
+
+from . import tasks
+from .blob_cache import BlobCache
+from .github import GitHub, GitHubRateLimitExceeded, get_session
 from .views import home
 from .models import FeatureSet, Repo, Feature
-from .tasks import delete_feature_set_features, delete_repo_feature_sets
+from .tasks import delete_feature_set_features, delete_repo_feature_sets, delete_retired_features, _claim_pending_sync, _discard_unfinished_generations, _get_blob_sha, _start_pending_sync, _sync_feature_set, _sync_features, schedule_feature_set_sync
 from .test_geojson import featurecollection_with_zs, featurecollection_no_zs
 from .utils import strip_zs
 
@@ -71,6 +87,21 @@ class ModelsTest(TestCase):
     def test_feature_set_bounds(self):
         self.assertEqual(self.fs.bounds, (-80.955914, 35.067714, -80.694945, 35.499112))
 
+    def test_backfill_features(self):
+        call_command('backfill_features', stdout=io.BytesIO())
+
+        self.assertEqual(Feature.objects.filter(feature_json='').count(), 0)
+        self.assertEqual(Feature.objects.filter(geom_1km__isnull=True).count(), 0)
+        feature = Feature.objects.filter(feature_set=self.fs)[0]
+        feature_json = json.loads(feature.feature_json)
+        self.assertEqual(feature_json['properties'], json.loads(feature.properties))
+        self.assertEqual(feature_json['geometry'], json.loads(feature.geom.json))
+
+    def test_feature_properties_read_as_string(self):
+        properties = Feature.objects.filter(feature_set=self.fs).values_list('properties', flat=True)[0]
+        self.assertTrue(isinstance(properties, basestring))
+        self.assertTrue('name' in json.loads(properties))
+
 
 class StripZTest(TestCase):
     def setUp(self):
@@ -85,6 +116,149 @@ class StripZTest(TestCase):
 
         self.assertEqual(new_featurecollection, featurecollection_no_zs)
 
+class BlobCacheTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = BlobCache(directory=self.directory, max_size=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_miss(self):
+        self.assertEqual(self.cache.open('abc123'), None)
+        self.assertFalse('abc123' in self.cache)
+
+    def test_store_and_open(self):
+        blob = self.cache.store('abc123', io.BytesIO(b'{"type":'))
+        self.assertEqual(blob.read(), b'{"type":')
+        blob.close()
+        self.assertTrue('abc123' in self.cache)
+        blob = self.cache.open('abc123')
+        self.assertEqual(blob.read(), b'{"type":')
+        blob.close()
+
+    def test_least_recently_used_evicted(self):
+        self.cache.store('old', io.BytesIO(b'1234')).close()
+        self.cache.store('used', io.BytesIO(b'1234')).close()
+        os.utime(self.cache.path('old'), (1, 1))
+        os.utime(self.cache.path('used'), (2, 2))
+        self.cache.open('used').close()
+        self.cache.store('new', io.BytesIO(b'1234')).close()
+        self.assertFalse('old' in self.cache)
+        self.assertTrue('used' in self.cache)
+        self.assertTrue('new' in self.cache)
+
+
+class FakeSession(object):
+    """
+    Stands in for requests.Session, answering GETs from a list of (status, headers, content)
+    """
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+        self.urls = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(headers)
+        self.urls.append(url)
+        status_code, response_headers, content = self.responses.pop(0)
+        response = Response()
+        response.status_code = status_code
+        response.url = url
+        response.headers = CaseInsensitiveDict(response_headers)
+        response._content = content
+        response.encoding = 'utf-8'
+        return response
+
+
+class GitHubTest(TestCase):
+    fixtures = ['gitspatial/fixtures/test_data.json']
+
+    def setUp(self):
+        self.jason = User.objects.get(id=5)
+        UserSocialAuth.objects.create(user=self.jason, provider='github', uid='5', extra_data={'access_token': 'abc123'})
+        get_cache('github').clear()
+        get_cache('github_rate_limit').clear()
+
+    def test_access_token_cached(self):
+        github = GitHub(self.jason)
+        self.assertEqual(github._headers, {'Authorization': 'token abc123'})
+        with self.assertNumQueries(0):
+            github = GitHub(self.jason)
+        self.assertEqual(github._headers, {'Authorization': 'token abc123'})
+
+    def test_conditional_get(self):
+        github = GitHub(self.jason)
+        github._session = FakeSession([
+            (200, {'ETag': '"abc"', 'X-RateLimit-Remaining': '4999'}, b'[{"id": 1}]'),
+            (304, {'ETag': '"abc"', 'X-RateLimit-Remaining': '4998'}, b''),
+        ])
+
+        first = github.get('/user/repos?conditional=1')
+        second = github.get('/user/repos?conditional=1')
+
+        self.assertEqual(first.json(), [{'id': 1}])
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json(), [{'id': 1}])
+        self.assertEqual(second.headers['X-RateLimit-Remaining'], '4998')
+        self.assertFalse('If-None-Match' in github._session.requests[0])
+        self.assertEqual(github._session.requests[1]['If-None-Match'], '"abc"')
+
+    def test_large_response_not_cached(self):
+        github = GitHub(self.jason)
+        github._session = FakeSession([
+            (200, {'ETag': '"abc"'}, b'[{"id": 1}]'),
+            (200, {'ETag': '"abc"'}, b'[{"id": 1}]'),
+        ])
+
+        with self.settings(GITHUB_CACHE_MAX_ENTRY_SIZE=4):
+            github.get('/user/repos?large=1')
+            github.get('/user/repos?large=1')
+
+        self.assertFalse('If-None-Match' in github._session.requests[1])
+
+    def test_blob_sha_from_directory_contents(self):
+        feature_set = FeatureSet.objects.get(id=3)
+        feature_set.path = 'data/colleges.geojson'
+        github = GitHub(self.jason)
+        github._session = FakeSession([
+            (200, {}, json.dumps([
+                {'type': 'file', 'path': 'data/airports.geojson', 'sha': 'abc123'},
+                {'type': 'file', 'path': 'data/colleges.geojson', 'sha': 'def456'},
+            ])),
+            (404, {}, b'{"message": "Not Found"}'),
+        ])
+
+        self.assertEqual(_get_blob_sha(github, feature_set), 'def456')
+        self.assertEqual(github._session.urls[0], 'https://api.github.com/repos/{0}/contents/data?ref={1}'.format(
+            feature_set.repo.full_name, feature_set.repo.master_branch))
+        self.assertEqual(_get_blob_sha(github, feature_set), None)
+
+    def test_rate_limit_tracked(self):
+        github = GitHub(self.jason)
+        reset = int(time.time()) + 600
+        github._session = FakeSession([
+            (200, {'X-RateLimit-Remaining': '300', 'X-RateLimit-Reset': str(reset)}, b'{}'),
+            (403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset)}, b'{}'),
+        ])
+
+        github.get('/rate_limited')
+        self.assertEqual(github.rate_limit, {'remaining': 300, 'reset': reset})
+        github.check_rate_limit(reserve=100)
+        self.assertRaises(GitHubRateLimitExceeded, github.check_rate_limit, reserve=500)
+
+        try:
+            github.get('/rate_limited')
+        except GitHubRateLimitExceeded as e:
+            pass
+        self.assertEqual(e.reset, reset)
+        self.assertTrue(0 < e.countdown <= 601)
+
+    def test_session_shared(self):
+        self.assertTrue(GitHub(self.jason)._session is GitHub(self.jason)._session)
+        self.assertTrue(GitHub(self.jason)._session is get_session())
+
+
 class TasksTest(TestCase):
     fixtures = ['gitspatial/fixtures/test_data.json']
 
@@ -97,10 +271,12 @@ class TasksTest(TestCase):
         features = Feature.objects.filter(feature_set=fs)
         self.assertTrue(len(features) > 0)
 
-        delete_feature_set_features(fs)
+        delete_feature_set_features(fs.id)
 
         features = Feature.objects.filter(feature_set=fs)
         self.assertEqual(len(features), 0)
+        self.assertEqual(FeatureSet.objects.get(id=3).blob_sha, '')
+        self.assertEqual(FeatureSet.objects.get(id=3).feature_count, None)
 
     def test_delete_repo_feature_sets(self):
         repo = Repo.objects.get(id=22)
@@ -108,7 +284,172 @@ class TasksTest(TestCase):
         fs = FeatureSet.objects.filter(repo=repo)
         self.assertTrue(len(fs) > 0)
 
-        delete_repo_feature_sets(repo)
+        delete_repo_feature_sets(repo.id)
 
         fs = FeatureSet.objects.filter(repo=repo)
         self.assertEqual(len(fs), 0)
+
+    def test_claim_pending_sync(self):
+        fs = FeatureSet.objects.get(id=3)
+
+        self.assertTrue(_claim_pending_sync(fs))
+        self.assertFalse(_claim_pending_sync(fs))
+
+        FeatureSet.objects.filter(id=fs.id).update(sync_pending_since=None)
+        self.assertTrue(_claim_pending_sync(fs))
+
+    def test_hook_collapsing_into_sync_with_blob_sha(self):
+        fs = FeatureSet.objects.get(id=3)
+        self.assertTrue(schedule_feature_set_sync(fs, blob_sha='old123'))
+        # A push lands while the sync queued with the tree's SHA is still pending
+        self.assertFalse(schedule_feature_set_sync(fs))
+
+        fs, blob_sha = _start_pending_sync(fs.id)
+
+        # So the sync looks up the SHA of the pushed file rather than using the old one
+        self.assertEqual(blob_sha, None)
+        fs = FeatureSet.objects.get(id=3)
+        self.assertEqual(fs.sync_pending_since, None)
+        self.assertEqual(fs.pending_blob_sha, '')
+
+    def test_latest_blob_sha_requested_wins(self):
+        fs = FeatureSet.objects.get(id=3)
+        self.assertTrue(schedule_feature_set_sync(fs, blob_sha='old123'))
+        self.assertFalse(schedule_feature_set_sync(fs, blob_sha='new456'))
+
+        self.assertEqual(_start_pending_sync(fs.id)[1], 'new456')
+
+    def test_claim_stale_pending_sync(self):
+        fs = FeatureSet.objects.get(id=3)
+        FeatureSet.objects.filter(id=fs.id).update(sync_pending_since=timezone.now() - datetime.timedelta(days=1))
+
+        self.assertTrue(_claim_pending_sync(fs))
+
+    def shop_features(self, count):
+        return [
+            {
+                'type': 'Feature',
+                'properties': {'name': 'Shop {0}'.format(i)},
+                'geometry': {'type': 'Point', 'coordinates': [-80.8 + i * 0.01, 35.2, 210.0]}
+            } for i in range(count)
+        ]
+
+    def test_sync_features(self):
+        fs = FeatureSet.objects.get(id=19)
+
+        with self.settings(FEATURE_SET_BATCH_SIZE=2):
+            counts = _sync_features(fs, self.shop_features(5), 1)
+
+        self.assertEqual(counts, {'total': 5, 'created': 5, 'deleted': 0, 'unchanged': 0})
+        self.assertEqual(Feature.objects.live(fs).count(), 0)
+        fs.generation = 1
+        self.assertEqual(Feature.objects.live(fs).count(), 5)
+        feature_json = json.loads(Feature.objects.live(fs).get(properties__contains='Shop 0').feature_json)
+        self.assertEqual(feature_json['properties'], {'name': 'Shop 0'})
+        self.assertEqual(feature_json['geometry'], {'type': 'Point', 'coordinates': [-80.8, 35.2]})
+        self.assertEqual(Feature.objects.live(fs).filter(geom_1km__isnull=True).count(), 0)
+
+    def test_sync_features_diff(self):
+        fs = FeatureSet.objects.get(id=19)
+        _sync_features(fs, self.shop_features(5), 1)
+        fs.generation = 1
+        unchanged_ids = set(Feature.objects.live(fs).exclude(properties__contains='Shop 4').values_list('id', flat=True))
+
+        features = self.shop_features(5)
+        features[4]['properties']['name'] = 'Bike Shop 4'
+        features.append(self.shop_features(6)[5])
+        counts = _sync_features(fs, features, 2)
+
+        self.assertEqual(counts, {'total': 6, 'created': 2, 'deleted': 1, 'unchanged': 4})
+        self.assertEqual(Feature.objects.live(fs).count(), 5)
+        fs.generation = 2
+        ids = set(Feature.objects.live(fs).values_list('id', flat=True))
+        self.assertEqual(len(ids), 6)
+        self.assertTrue(unchanged_ids < ids)
+
+    def test_delete_retired_features(self):
+        fs = FeatureSet.objects.get(id=19)
+        _sync_features(fs, self.shop_features(5), 1)
+        fs.generation = 1
+        fs.save(update_fields=['generation'])
+        _sync_features(fs, self.shop_features(3), 2)
+        FeatureSet.objects.filter(id=fs.id).update(generation=2)
+
+        delete_retired_features(fs.id)
+
+        self.assertEqual(Feature.objects.filter(feature_set=fs).count(), 3)
+
+    def test_discard_unfinished_generations(self):
+        fs = FeatureSet.objects.get(id=19)
+        _sync_features(fs, self.shop_features(5), 1)
+        fs.generation = 1
+        _sync_features(fs, self.shop_features(3)[1:] + self.shop_features(6)[5:], 2)
+
+        _discard_unfinished_generations(fs)
+
+        self.assertEqual(Feature.objects.filter(feature_set=fs).count(), 5)
+        self.assertEqual(Feature.objects.live(fs).count(), 5)
+
+    def test_sync_skipped_for_ingested_blob(self):
+        fs = FeatureSet.objects.get(id=19)
+        fs.blob_sha = 'abc123'
+        fs.save(update_fields=['blob_sha'])
+
+        # The owner has no GitHub token, so this fails if it goes to GitHub
+        _sync_feature_set(fs, 'abc123', False)
+
+        fs = FeatureSet.objects.get(id=19)
+        self.assertEqual(fs.sync_status, FeatureSet.SYNCED)
+        self.assertEqual(fs.generation, 0)
+        self.assertEqual(Feature.objects.filter(feature_set=fs).count(), 0)
+
+    def test_forced_sync_from_blob_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        fs = FeatureSet.objects.get(id=19)
+        fs.blob_sha = 'abc123'
+        fs.save(update_fields=['blob_sha'])
+        featurecollection = {'type': 'FeatureCollection', 'features': self.shop_features(3)}
+
+        with self.settings(BLOB_CACHE_DIR=directory):
+            BlobCache().store('abc123', io.BytesIO(json.dumps(featurecollection).encode('utf-8'))).close()
+            _sync_feature_set(fs, None, True)
+
+        fs = FeatureSet.objects.get(id=19)
+        self.assertEqual(fs.sync_status, FeatureSet.SYNCED)
+        self.assertEqual(fs.generation, 1)
+        self.assertEqual(fs.feature_count, 3)
+        self.assertEqual(Feature.objects.live(fs).count(), 3)
+
+    def failing_sync(self, exception):
+        """
+        Sync feature set 19 from a cached blob with _sync_features raising exception once it has written its rows
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        fs = FeatureSet.objects.get(id=19)
+        featurecollection = {'type': 'FeatureCollection', 'features': self.shop_features(3)}
+
+        def sync_features(*args):
+            _sync_features(*args)
+            raise exception
+        tasks._sync_features = sync_features
+        self.addCleanup(setattr, tasks, '_sync_features', _sync_features)
+
+        with self.settings(BLOB_CACHE_DIR=directory):
+            BlobCache().store('abc123', io.BytesIO(json.dumps(featurecollection).encode('utf-8'))).close()
+            self.assertRaises(type(exception), _sync_feature_set, fs, 'abc123', False)
+        return FeatureSet.objects.get(id=19)
+
+    def test_failed_sync_marked_as_error(self):
+        fs = self.failing_sync(RuntimeError('Lost the database'))
+
+        self.assertEqual(fs.sync_status, FeatureSet.ERROR_SYNCING)
+        self.assertEqual(fs.generation, 0)
+        self.assertEqual(Feature.objects.filter(feature_set=fs).count(), 0)
+
+    def test_sync_out_of_memory_marked_as_memory_error(self):
+        fs = self.failing_sync(MemoryError())
+
+        self.assertEqual(fs.sync_status, FeatureSet.MEMORY_ERROR)
+        self.assertEqual(Feature.objects.filter(feature_set=fs).count(), 0)
@@ -1,12 +1,16 @@
+import hashlib
 import json
 import random
 import string
+import time
 
 from django.contrib.auth.models import User
+from django.core.cache import get_cache
 from django.core.exceptions import PermissionDenied
 from django.http import Http404
 from django.test import TestCase
 from django.test.client import RequestFactory
+from social_auth.models import UserSocialAuth
 
 from ..models import Repo, FeatureSet
 from .views import user_repo, user_feature_set, user_repo_sync, user_repo_sync_status, user_feature_set_sync_status, user_feature_set_sync, user_landing
@@ -49,6 +53,18 @@ class UserRepoSyncTest(TestCase):
         response = user_repo_sync(request, repo_id=22)
         self.assertEqual(response.status_code, 403)
 
+    def test_sync_when_rate_limited(self):
+        UserSocialAuth.objects.create(user=self.jason, provider='github', uid='5', extra_data={'access_token': 'abc123'})
+        token_key = hashlib.sha1('token abc123').hexdigest()
+        get_cache('github_rate_limit').set('github-rate-limit:' + token_key, {'remaining': 0, 'reset': int(time.time()) + 590})
+        self.addCleanup(get_cache('github_rate_limit').clear)
+        for method in ('post', 'delete'):
+            request = getattr(self.factory, method)('/user/repo/22/sync')
+            request.user = self.jason
+            response = user_repo_sync(request, repo_id=22)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(json.loads(response.content)['message'], 'GitHub\'s API rate limit for your account has been reached. Try again in 10 minutes.')
+
     def test_invalid_method_put(self):
         request = self.factory.put('/user/repo/22/sync?testing=1')
         request.user = self.jason
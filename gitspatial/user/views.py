@@ -9,14 +9,26 @@ from django.http import Http404, HttpResponseBadRequest, HttpResponseForbidden
 from django.shortcuts import render, HttpResponse, redirect, get_object_or_404
 from django.views.decorators.http import require_http_methods, require_GET
 
-from ..github import GitHub
+from ..github import GitHub, GitHubRateLimitExceeded
 from ..models import Repo, FeatureSet, Feature
-from ..tasks import get_user_repos, get_repo_feature_sets, delete_repo_feature_sets, get_feature_set_features, delete_feature_set_features
+from ..tasks import get_user_repos, get_repo_feature_sets, delete_repo_feature_sets, delete_feature_set_features, schedule_feature_set_sync, USER_SYNC_QUEUE
 
 
 logger = logging.getLogger(__name__)
 
 
+def rate_limited(e):
+    """
+    A 503 JSON response for when the user's GitHub rate limit has run out
+    """
+    minutes = (e.countdown + 59) // 60
+    message = 'GitHub\'s API rate limit for your account has been reached. Try again in {0} minute{1}.'.format(
+        minutes, '' if minutes == 1 else 's')
+    response = HttpResponse(json.dumps({'status': 'error', 'message': message}), content_type='application/json', status=503)
+    response['Retry-After'] = str(e.countdown)
+    return response
+
+
 @login_required
 def user_landing(request):
     """
@@ -25,7 +37,7 @@ def user_landing(request):
     User landing page
     """
     # TODO: Only do this at sign up. Subsequent re-checks of new/updated repos should be scheduled.
-    get_user_repos.apply_async((request.user,))
+    get_user_repos.apply_async((request.user.id,))
     user_repos = Repo.objects.filter(user=request.user).extra(select={'lower_name': 'lower(name)'}).order_by('-synced', 'lower_name')
     context = {'user_repos': user_repos}
     return render(request, 'user.html', context)
@@ -57,7 +69,7 @@ def user_feature_set(request, feature_set_id):
         if feature_set.is_syncing:
             context = {'feature_set': feature_set}
         else:
-            count = Feature.objects.filter(feature_set=feature_set).count()
+            count = Feature.objects.live(feature_set).count()
 
             requested_page = request.GET.get('page', 1)
 
@@ -66,7 +78,7 @@ def user_feature_set(request, feature_set_id):
             except ValueError:
                 return redirect('user_feature_set', feature_set_id=feature_set_id)
 
-            features = Feature.objects.filter(feature_set=feature_set).geojson()
+            features = Feature.objects.live(feature_set).geojson()
 
             paginated = Paginator(features, per_page)
 
@@ -176,13 +188,18 @@ def user_repo_sync(request, repo_id):
             }
         }
         github = GitHub(repo.user)
-        gh_request = github.post('/repos/{0}/hooks'.format(repo.full_name), hook_data)
+        try:
+            github.check_rate_limit()
+            gh_request = github.post('/repos/{0}/hooks'.format(repo.full_name), hook_data)
+        except GitHubRateLimitExceeded as e:
+            logger.warning('Hook not created for repo {0}: {1}'.format(repo, e))
+            return rate_limited(e)
         if gh_request.status_code == 201:
             logger.info('Hook created for repo: {0}'.format(repo))
         else:
             logger.info('Hook not created for repo: {0}'.format(repo))
         repo.save()
-        get_repo_feature_sets.apply_async((repo,))
+        get_repo_feature_sets.apply_async((repo.id,), {'queue': USER_SYNC_QUEUE}, queue=USER_SYNC_QUEUE)
         return HttpResponse(json.dumps({'status': 'ok'}), content_type='application/json', status=201)
     else:  # DELETE
         # See tests for the why on this awfulness
@@ -192,21 +209,26 @@ def user_repo_sync(request, repo_id):
         repo.synced = False
         repo.sync_status = repo.NOT_SYNCED
         github = GitHub(repo.user)
-        gh_request = github.get('/repos/{0}/hooks'.format(repo.full_name))
-        hook_id_to_delete = None
-
-        for hook in gh_request.json():
-            if 'url' in hook['config'] and hook['config']['url'] == repo.hook_url:
-                hook_id_to_delete = hook['id']
-                continue
-
-        if hook_id_to_delete is not None:
-            gh_request = github.delete('/repos/{0}/hooks/{1}'.format(repo.full_name, hook_id_to_delete))
-            if gh_request.status_code == 204:
-                logger.info('Hook deleted for repo: {0}'.format(repo))
-                delete_repo_feature_sets.apply_async((repo,))
-            else:
-                logger.warning('Hook not deleted for repo: {0}'.format(repo))
+        try:
+            github.check_rate_limit()
+            gh_request = github.get('/repos/{0}/hooks'.format(repo.full_name))
+            hook_id_to_delete = None
+
+            for hook in gh_request.json():
+                if 'url' in hook['config'] and hook['config']['url'] == repo.hook_url:
+                    hook_id_to_delete = hook['id']
+                    continue
+
+            if hook_id_to_delete is not None:
+                gh_request = github.delete('/repos/{0}/hooks/{1}'.format(repo.full_name, hook_id_to_delete))
+                if gh_request.status_code == 204:
+                    logger.info('Hook deleted for repo: {0}'.format(repo))
+                    delete_repo_feature_sets.apply_async((repo.id,))
+                else:
+                    logger.warning('Hook not deleted for repo: {0}'.format(repo))
+        except GitHubRateLimitExceeded as e:
+            logger.warning('Hook not deleted for repo {0}: {1}'.format(repo, e))
+            return rate_limited(e)
         repo.save()
         return HttpResponse(json.dumps({'status': 'ok'}), content_type='application/json', status=204)
 
@@ -255,13 +277,13 @@ def user_feature_set_sync(request, feature_set_id):
         feature_set.synced = True
         feature_set.sync_status = FeatureSet.SYNCING
         feature_set.save()
-        get_feature_set_features.apply_async((feature_set,))
+        schedule_feature_set_sync(feature_set, countdown=0, queue=USER_SYNC_QUEUE)
         return HttpResponse(json.dumps({'status': 'ok'}), content_type='application/json', status=201)
     else:  # DELETE
         feature_set.synced = False
         feature_set.sync_status = FeatureSet.NOT_SYNCED
         feature_set.save()
-        delete_feature_set_features.apply_async((feature_set,))
+        delete_feature_set_features.apply_async((feature_set.id,))
         return HttpResponse(json.dumps({'status': 'ok'}), content_type='application/json', status=204)
 
 
@@ -1,3 +1,7 @@
+import hashlib
+import json
+
+
 def disk_size_format(num):
     for x in ['bytes', 'KB', 'MB', 'GB', 'TB']:
         if num < 1024.0:
@@ -13,3 +17,18 @@ def strip_zs(geojson_geometry):
         for i, coords_set in enumerate(geojson_geometry['coordinates']):
             geojson_geometry['coordinates'][i] = [coord[:2] for coord in coords_set]
     return geojson_geometry
+
+
+def feature_hash(geojson_geometry, properties):
+    """
+    A stable SHA-1 hex digest of a GeoJSON feature's geometry and properties
+    """
+    content = json.dumps({'geometry': geojson_geometry, 'properties': properties}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def feature_fragment(geojson_geometry, properties):
+    """
+    A GeoJSON Feature serialized without an id, ready to be spliced into API responses
+    """
+    return json.dumps({'type': 'Feature', 'properties': properties, 'geometry': geojson_geometry})
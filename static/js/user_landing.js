@@ -18,8 +18,9 @@ $(document).ready(function () {
                 success: function () {
                     visuallyUpdateRepoStatus(repo_id, 'not_synced');
                 },
-                error: function () {
-                    alert('there was an error syncing');
+                error: function (jqXHR) {
+                    response = JSON.parse(jqXHR.responseText || '{}');
+                    alert('message' in response ? response.message : 'there was an error syncing');
                 }
             });
         } else {
@@ -32,6 +33,9 @@ $(document).ready(function () {
                 },
                 error: function (jqXHR) {
                     response = JSON.parse(jqXHR.responseText);
+                    if (jqXHR.status === 503) {
+                        visuallyUpdateRepoStatus(repo_id, 'not_synced');
+                    }
                     if ('message' in response) {
                         alert(response.message);
                     }